@@ -1,139 +1,274 @@
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from tkinter import *
-import os
+from tkinter import messagebox
+from tkinter import ttk
+from pms_ledger import Ledger
+from pms_metrics import Metrics
+from pms_store import open_store
 
-f = open("database_proj", 'a+')
+# python PMS.py pharmacy.db keeps the inventory in SQLite instead
+DB = sys.argv[1] if len(sys.argv) > 1 else "database_proj"
+ledger = Ledger(DB + ".ledger")
+store = open_store(DB, ledger=ledger)
+worker = ThreadPoolExecutor(max_workers=1)
+metrics = Metrics()
+# timings are also written to database_proj.metrics.json and .prom every DUMP_INTERVAL ms
+METRICS_PATH = DB + ".metrics"
+DUMP_INTERVAL = 10000
+DEBUG_INTERVAL = 1000
+debugwindow = None
+# compaction runs on a thread of the store's own, time it there
+for part in getattr(store, "shards", [store]):
+    if hasattr(part, "compact"):
+        part.compact = partial(metrics.call, "compact", part.compact)
 root = Tk()
 root.title("Pharmacy Management System")
 root.configure(width=1500, height=600, bg='BLACK')
 var = -1
+# SQLite leaves record numbers out (var None); varname's is then counted when next/previous need it
+varname = None
+busy = 0
+lagmax = 0.0
+LAG_INTERVAL = 100
+PAGE_ROWS = 25
+listwindow = None
+listtop = 0
+# record count as of the last page read; pageloading while a read is out, pagewanted the top asked for meanwhile
+listtotal = 0
+pageloading = False
+pagewanted = None
+lowwindow = None
+LOW_INTERVAL = 5000
+# added items are saved together, once BATCH_ROWS are waiting or BATCH_DELAY ms after the first
+BATCH_ROWS = 20
+BATCH_DELAY = 2000
+pending = []
+saving = 0
+flushjob = None
+records = 0
+
+
+def runstorage(done, task, *args):
+    # storage calls run on the worker thread, done(future) runs back on Tk
+    global busy
+    busy += 1
+    status.config(text="WORKING...")
+    root.config(cursor="watch")
+    op = getattr(task, "__name__", "task")
+    submitted = time.perf_counter()
+    future = worker.submit(timedstorage, op, submitted, task, *args)
+    root.after(10, checkstorage, future, done, op, submitted)
+
+
+def timedstorage(op, submitted, task, *args):
+    # on the worker: time spent queued behind other calls, then the call itself
+    metrics.observe("queue", op, time.perf_counter() - submitted)
+    return metrics.call(op, task, *args)
+
+
+def checkstorage(future, done, op, submitted):
+    global busy
+    if not future.done():
+        root.after(10, checkstorage, future, done, op, submitted)
+        return
+    busy -= 1
+    if not busy:
+        status.config(text="READY")
+        root.config(cursor="")
+    with metrics.timed("ui", op):
+        done(future)
+    metrics.observe("total", op, time.perf_counter() - submitted)
+
+
+def heartbeat(expected):
+    # how late this tick fired is how long the event loop was blocked
+    global lagmax
+    lag = max(0.0, (time.perf_counter() - expected) * 1000)
+    lagmax = max(lagmax, lag)
+    metrics.observe("ui", "lag", lag / 1000)
+    lagtext.config(text="UI LAG %.0f ms (MAX %.0f ms)" % (lag, lagmax))
+    root.after(LAG_INTERVAL, heartbeat, time.perf_counter() + LAG_INTERVAL / 1000)
+
+
+def show_record(v):
+    entry1.delete(0, END)
+    entry2.delete(0, END)
+    entry3.delete(0, END)
+    entry4.delete(0, END)
+    entry5.delete(0, END)
+    entry1.insert(0, str(v[0]))
+    entry2.insert(0, str(v[1]))
+    entry3.insert(0, str(v[2]))
+    entry4.insert(0, str(v[3]))
+    entry5.insert(0, str(v[4]))
 
 
 def additem():
-    global var
-    num_lines = 0
-    with open("database_proj", 'r') as f10:
-        for line in f10:
-            num_lines += 1
-    var = num_lines - 1
+    global flushjob
     e1 = entry1.get()
     e2 = entry2.get()
     e3 = entry3.get()
     e4 = entry4.get()
     e5 = entry5.get()
-    f.write('{0} {1} {2} {3} {4}\n'.format(str(e1), e2, e3, str(e4), e5))
+    fields = (str(e1), e2, e3, str(e4), e5)
+    try:
+        store.check(fields)
+    except ValueError:
+        messagebox.showinfo("Title", "INVALID ITEM DETAILS")
+        return
+    if any(waiting[0] == fields[0] for waiting in pending):
+        messagebox.showinfo("Title", "ITEM ALREADY EXISTS")
+        return
+    pending.append(fields)
     entry1.delete(0, END)
     entry2.delete(0, END)
     entry3.delete(0, END)
     entry4.delete(0, END)
     entry5.delete(0, END)
+    showpending()
+    if len(pending) >= BATCH_ROWS:
+        flushpending()
+    elif flushjob is None:
+        flushjob = root.after(BATCH_DELAY, flushpending)
+
+
+def flushpending():
+    # runs on the worker ahead of anything submitted after it
+    global flushjob, saving
+    if flushjob is not None:
+        root.after_cancel(flushjob)
+        flushjob = None
+    if not pending:
+        return
+    batch = pending[:]
+    del pending[:]
+    saving += len(batch)
+    showpending()
+    runstorage(lambda future: flushdone(future, batch), store.add_many, batch)
+
+
+def flushdone(future, batch):
+    global var, saving, records
+    saving -= len(batch)
+    try:
+        skipped = future.result()
+    except OSError:
+        pending[:0] = batch
+        showpending()
+        messagebox.showinfo("Title", "COULD NOT SAVE PENDING ITEMS")
+        return
+    except ValueError as error:
+        # retrying would fail the same way, drop the batch
+        showpending()
+        messagebox.showinfo("Title", "INVALID ITEM DETAILS, NOT SAVED: %s\n%s"
+                            % (", ".join(fields[0] for fields in batch), error))
+        return
+    records += len(batch) - len(skipped)
+    var = records - 1
+    showpending()
+    if skipped:
+        messagebox.showinfo("Title", "ITEM ALREADY EXISTS: " + ", ".join(skipped))
+    refreshlist()
+    refreshlow()
+
+
+def showpending():
+    counttext.config(text="%d RECORDS" % records)
+    if pending or saving:
+        pendingtext.config(text="%d PENDING, %d SAVING" % (len(pending), saving), fg="yellow")
+    else:
+        pendingtext.config(text="ALL SAVED", fg="white")
+
+
+def countdone(future):
+    global records
+    records = future.result()
+    showpending()
 
 
 def deleteitem():
     e1 = entry1.get()
-    with open(r"database_proj") as f, open(r"database_proj1", "w") as working:
-        for line in f:
-            if str(e1) not in line:
-                working.write(line)
-    os.remove(r"database_proj")
-    os.rename(r"database_proj1", r"database_proj")
-    f.close()
-    working.close()
-    entry1.delete(0, END)
-    entry2.delete(0, END)
-    entry3.delete(0, END)
-    entry4.delete(0, END)
-    entry5.delete(0, END)
+    flushpending()
+    runstorage(deleteitemdone, store.delete, e1)
 
 
-def firstitem():
-    global var
-    var = 0
-    f.seek(var)
-    c = f.readline()
-    v = list(c.split(" "))
+def deleteitemdone(future):
+    global records
+    try:
+        future.result()
+    except KeyError:
+        messagebox.showinfo("Title", "NO SUCH ITEM")
+        return
+    records -= 1
+    showpending()
     entry1.delete(0, END)
     entry2.delete(0, END)
     entry3.delete(0, END)
     entry4.delete(0, END)
     entry5.delete(0, END)
-    entry1.insert(0, str(v[0]))
-    entry2.insert(0, str(v[1]))
-    entry3.insert(0, str(v[2]))
-    entry4.insert(0, str(v[3]))
-    entry5.insert(0, str(v[4]))
+    refreshlist()
+    refreshlow()
 
 
-def nextitem():
+def moveto(num):
+    flushpending()
+    runstorage(lambda future: movedone(future, num), store.record, num)
+
+
+def movedone(future, num):
     global var
-    var = var + 1
-    f.seek(var)
     try:
-        c = f.readlines()
-        xyz = c[var]
-        v = list(xyz.split(" "))
-        entry1.delete(0, END)
-        entry2.delete(0, END)
-        entry3.delete(0, END)
-        entry4.delete(0, END)
-        entry5.delete(0, END)
-        entry1.insert(0, str(v[0]))
-        entry2.insert(0, str(v[1]))
-        entry3.insert(0, str(v[2]))
-        entry4.insert(0, str(v[3]))
-        entry5.insert(0, str(v[4]))
-    except:
+        show_record(future.result())
+        var = num
+    except IndexError:
         messagebox.showinfo("Title", "SORRY!...NO MORE RECORDS")
 
 
+def firstitem():
+    moveto(0)
+
+
+def nextitem():
+    stepitem(1)
+
+
 def previousitem():
-    global var
-    var = var - 1
-    f.seek(var)
-    try:
-        z = f.readlines()
-        xyz = z[var]
-        v = list(xyz.split(" "))
-        entry1.delete(0, END)
-        entry2.delete(0, END)
-        entry3.delete(0, END)
-        entry4.delete(0, END)
-        entry5.delete(0, END)
-
-        entry1.insert(0, str(v[0]))
-        entry2.insert(0, str(v[1]))
-        entry3.insert(0, str(v[2]))
-        entry4.insert(0, str(v[3]))
-        entry5.insert(0, str(v[4]))
-    except:
-        messagebox.showinfo("Title", "SORRY!...NO MORE RECORDS")
+    stepitem(-1)
+
+
+def stepitem(step):
+    flushpending()
+    runstorage(numbereddone, steprecord, var, varname, step)
+
+
+def steprecord(num, name, step):
+    if num is None:
+        num = store.position(name)
+    return num + step, store.record(num + step)
 
 
 def lastitem():
+    flushpending()
+    runstorage(numbereddone, lastrecord)
+
+
+def lastrecord():
+    num = len(store) - 1
+    return num, store.record(num)
+
+
+def numbereddone(future):
     global var
-    f4 = open("database_proj", 'r')
-    x = f4.read().splitlines()
-    last_line = x[-1]
-    num_lines = 0
-    with open("database_proj", 'r') as f8:
-        for line in f8:
-            num_lines += 1
-    var = num_lines - 1
-    print(last_line)
     try:
-        v = list(last_line.split(" "))
-        entry1.delete(0, END)
-        entry2.delete(0, END)
-        entry3.delete(0, END)
-        entry4.delete(0, END)
-        entry5.delete(0, END)
-
-        entry1.insert(0, str(v[0]))
-        entry2.insert(0, str(v[1]))
-        entry3.insert(0, str(v[2]))
-        entry4.insert(0, str(v[3]))
-        entry5.insert(0, str(v[4]))
-    except:
+        var, v = future.result()
+        show_record(v)
+    except IndexError:
         messagebox.showinfo("Title", "SORRY!...NO MORE RECORDS")
+    except KeyError:
+        messagebox.showinfo("Title", "NO SUCH ITEM")
 
 
 def updateitem():
@@ -142,43 +277,69 @@ def updateitem():
     e3 = entry3.get()
     e4 = entry4.get()
     e5 = entry5.get()
-    with open(r"database_proj") as f1, open(r"database_proj1", "w") as working:
-        for line in f1:
-            if str(e1) not in line:
-                working.write(line)
-            else:
-                working.write('{0} {1} {2} {3} {4}'.format(str(e1), e2, e3, str(e4), e5))
-    os.remove(r"database_proj")
-    # brought to you by code-projects.org
-    os.rename(r"database_proj1", r"database_proj")
+    flushpending()
+    runstorage(lambda future: updateitemdone(future, str(e1)), store.update, (str(e1), e2, e3, str(e4), e5))
+
+
+def updateitemdone(future, name):
+    global var, varname
+    try:
+        var = future.result()
+        varname = name
+    except ValueError:
+        messagebox.showinfo("Title", "INVALID ITEM DETAILS")
+    except KeyError:
+        messagebox.showinfo("Title", "NO SUCH ITEM")
+    refreshlist()
+    refreshlow()
 
 
 def searchitem():
-    i = 0
     e11 = entry1.get()
-    with open(r"database_proj") as working:
-        for line in working:
-            i = i + 1
-            if str(e11) in line:
-                break
-        try:
-            v = list(line.split(" "))
-            entry1.delete(0, END)
-            entry2.delete(0, END)
-            entry3.delete(0, END)
-            entry4.delete(0, END)
-            entry5.delete(0, END)
-            entry1.insert(0, str(v[0]))
-            entry2.insert(0, str(v[1]))
-            entry3.insert(0, str(v[2]))
-            entry4.insert(0, str(v[3]))
-            entry5.insert(0, str(v[4]))
-        except:
-            messagebox.showinfo("Title", "error end of file")
-    working.close()
+    flushpending()
+    runstorage(searchitemdone, store.search, e11)
+
+
+def searchitemdone(future):
+    global var, varname
+    found = future.result()
+    if found is None:
+        runstorage(showsuggestions, store.fuzzy, entry1.get())
+        messagebox.showinfo("Title", "NO EXACT MATCH, SEE SUGGESTIONS")
+    else:
+        var, v = found
+        varname = v[0]
+        show_record(v)
+
+
+def suggestitem(event):
+    # as-you-type completion of the item name
+    if event.keysym in ("Return", "Tab", "Up", "Down"):
+        return
+    typed = entry1.get()
+    if typed:
+        runstorage(showsuggestions, store.suggest, typed)
+    else:
+        suggestions.delete(0, END)
+
+
+def showsuggestions(future):
+    suggestions.delete(0, END)
+    for name in future.result():
+        suggestions.insert(END, name)
+
+
+def picksuggestion(event):
+    chosen = suggestions.curselection()
+    if chosen:
+        name = suggestions.get(chosen[0])
+        entry1.delete(0, END)
+        entry1.insert(0, name)
+        runstorage(searchitemdone, store.search, name)
 
 
 def clearitem():
+    suggestions.delete(0, END)
     entry1.delete(0, END)
     entry2.delete(0, END)
     entry3.delete(0, END)
@@ -186,6 +347,202 @@ def clearitem():
     entry5.delete(0, END)
 
 
+def fillpage(top):
+    # only the visible page of records is ever read or held by the tree
+    global listtop, pageloading, pagewanted
+    listtop = max(0, min(top, listtotal - PAGE_ROWS))
+    if pageloading:
+        # scrolled again before the last page came back, read only the newest
+        pagewanted = listtop
+        return
+    pageloading = True
+    runstorage(showpage, readpage, listtop)
+
+
+def readpage(top):
+    # on the worker: the count and the page at top, clamped to the records there are now
+    total = len(store)
+    top = max(0, min(top, total - PAGE_ROWS))
+    return total, top, store.page(top, PAGE_ROWS)
+
+
+def showpage(future):
+    global listtop, listtotal, pageloading, pagewanted
+    pageloading = False
+    total, top, page = future.result()
+    listtotal = total
+    if pagewanted is not None:
+        top, pagewanted = pagewanted, None
+        fillpage(top)
+        return
+    if listwindow is None or not listwindow.winfo_exists():
+        return
+    listtop = top
+    tree.delete(*tree.get_children())
+    for num, record in enumerate(page, listtop):
+        tree.insert("", END, iid=str(num), values=record)
+    if total:
+        listscroll.set(listtop / total, min(1.0, (listtop + PAGE_ROWS) / total))
+    else:
+        listscroll.set(0, 1)
+
+
+def scrolllist(action, amount, unit=None):
+    if action == "moveto":
+        fillpage(int(float(amount) * listtotal))
+    elif unit == "pages":
+        fillpage(listtop + int(amount) * PAGE_ROWS)
+    else:
+        fillpage(listtop + int(amount))
+
+
+def wheellist(event):
+    if event.num == 4 or event.delta > 0:
+        fillpage(listtop - 3)
+    else:
+        fillpage(listtop + 3)
+
+
+def selectlist(event):
+    chosen = tree.selection()
+    if chosen:
+        moveto(int(chosen[0]))
+
+
+def refreshlist():
+    if listwindow is not None and listwindow.winfo_exists():
+        fillpage(listtop)
+
+
+def viewlist():
+    global listwindow, tree, listscroll
+    if listwindow is not None and listwindow.winfo_exists():
+        listwindow.lift()
+        return
+    listwindow = Toplevel(root)
+    listwindow.title("All Items")
+    tree = ttk.Treeview(listwindow, columns=("name", "price", "quantity", "category", "discount"),
+                        show="headings", height=PAGE_ROWS)
+    for column in ("name", "price", "quantity", "category", "discount"):
+        tree.heading(column, text="ITEM " + column.upper())
+    listscroll = Scrollbar(listwindow, orient=VERTICAL, command=scrolllist)
+    tree.grid(row=0, column=0, sticky=NSEW)
+    listscroll.grid(row=0, column=1, sticky=NS)
+    tree.bind("<<TreeviewSelect>>", selectlist)
+    tree.bind("<MouseWheel>", wheellist)
+    tree.bind("<Button-4>", wheellist)
+    tree.bind("<Button-5>", wheellist)
+    tree.bind("<Prior>", lambda event: scrolllist("scroll", -1, "pages"))
+    tree.bind("<Next>", lambda event: scrolllist("scroll", 1, "pages"))
+    fillpage(listtop)
+
+
+def filllow(future):
+    if lowwindow is None or not lowwindow.winfo_exists():
+        return
+    lowtree.delete(*lowtree.get_children())
+    for record, level in future.result():
+        lowtree.insert("", END, values=(record.name, record.quantity, level, record.category))
+    lowcount.config(text="%d ITEMS AT OR BELOW REORDER LEVEL" % len(lowtree.get_children()))
+
+
+def refreshlow():
+    if lowwindow is not None and lowwindow.winfo_exists():
+        runstorage(filllow, store.low_stock)
+
+
+def polllow():
+    # picks up stock changed by other processes too
+    if lowwindow is not None and lowwindow.winfo_exists():
+        refreshlow()
+        root.after(LOW_INTERVAL, polllow)
+
+
+def setlevel(item=None, category=None):
+    text = levelentry.get().strip()
+    try:
+        level = int(text) if text else None
+    except ValueError:
+        messagebox.showinfo("Title", "INVALID REORDER LEVEL")
+        return
+    if not (item if item is not None else category):
+        messagebox.showinfo("Title", "ENTER THE ITEM NAME FIRST")
+        return
+    runstorage(setleveldone, store.set_reorder, level, item, category)
+
+
+def setleveldone(future):
+    future.result()
+    refreshlow()
+
+
+def viewlowstock():
+    global lowwindow, lowtree, lowcount, levelentry
+    if lowwindow is not None and lowwindow.winfo_exists():
+        lowwindow.lift()
+        return
+    lowwindow = Toplevel(root)
+    lowwindow.title("Low Stock")
+    lowtree = ttk.Treeview(lowwindow, columns=("name", "quantity", "level", "category"), show="headings",
+                           height=PAGE_ROWS)
+    for column, text in (("name", "ITEM NAME"), ("quantity", "QUANTITY"), ("level", "REORDER LEVEL"),
+                         ("category", "CATEGORY")):
+        lowtree.heading(column, text=text)
+    lowscroll = Scrollbar(lowwindow, orient=VERTICAL, command=lowtree.yview)
+    lowtree.configure(yscrollcommand=lowscroll.set)
+    lowcount = Label(lowwindow, text="", font=("Times", 12))
+    levelentry = Entry(lowwindow, font=("Times", 12))
+    itembutton = Button(lowwindow, text="SET LEVEL FOR ITEM", font=("Times", 12),
+                        command=lambda: setlevel(item=entry1.get()))
+    categorybutton = Button(lowwindow, text="SET LEVEL FOR CATEGORY", font=("Times", 12),
+                            command=lambda: setlevel(category=entry4.get()))
+    lowtree.grid(row=0, column=0, columnspan=3, sticky=NSEW)
+    lowscroll.grid(row=0, column=3, sticky=NS)
+    lowcount.grid(row=1, column=0, columnspan=3, sticky=W, padx=10, pady=10)
+    levelentry.grid(row=2, column=0, padx=10, pady=10)
+    itembutton.grid(row=2, column=1, padx=10, pady=10)
+    categorybutton.grid(row=2, column=2, padx=10, pady=10)
+    polllow()
+
+
+def filldebug():
+    if debugwindow is None or not debugwindow.winfo_exists():
+        return
+    debugtree.delete(*debugtree.get_children())
+    for row in metrics.summary():
+        debugtree.insert("", END, values=(row["stage"], row["op"], row["count"], row["p50_ms"], row["p90_ms"],
+                                          row["p99_ms"], row["max_ms"], row["bytes_read"] // 1024,
+                                          row["bytes_written"] // 1024, row["page_faults"]))
+    root.after(DEBUG_INTERVAL, filldebug)
+
+
+def viewdebug():
+    global debugwindow, debugtree
+    if debugwindow is not None and debugwindow.winfo_exists():
+        debugwindow.lift()
+        return
+    debugwindow = Toplevel(root)
+    debugwindow.title("Operation Timings")
+    columns = (("stage", "STAGE"), ("op", "OPERATION"), ("count", "CALLS"), ("p50", "P50 ms"), ("p90", "P90 ms"),
+               ("p99", "P99 ms"), ("max", "MAX ms"), ("read", "READ KB"), ("written", "WRITTEN KB"),
+               ("faults", "PAGE FAULTS"))
+    debugtree = ttk.Treeview(debugwindow, columns=[column for column, text in columns], show="headings",
+                             height=PAGE_ROWS)
+    for column, text in columns:
+        debugtree.heading(column, text=text)
+        debugtree.column(column, width=100)
+    debugtree.grid(row=0, column=0, sticky=NSEW)
+    filldebug()
+
+
+def dumpmetrics():
+    try:
+        metrics.dump(METRICS_PATH)
+    except OSError:
+        pass
+    root.after(DUMP_INTERVAL, dumpmetrics)
+
+
 # fn1353
 label0 = Label(root, text="PHARMACY MANAGEMENT SYSTEM ", bg="black", fg="white", font=("Times", 30))
 label1 = Label(root, text="ENTER ITEM NAME", bg="Blue", relief="ridge", fg="white", font=("Times", 12), width=25)
@@ -211,6 +568,15 @@ button6 = Button(root, text="VIEW LAST ITEM", bg="white", fg="black", width=20,
 button7 = Button(root, text="UPDATE ITEM", bg="white", fg="black", width=20, font=("Times", 12), command=updateitem)
 button8 = Button(root, text="SEARCH ITEM", bg="white", fg="black", width=20, font=("Times", 12), command=searchitem)
 button9 = Button(root, text="CLEAR SCREEN", bg="white", fg="black", width=20, font=("Times", 12), command=clearitem)
+button10 = Button(root, text="VIEW ALL ITEMS", bg="white", fg="black", width=20, font=("Times", 12), command=viewlist)
+suggestions = Listbox(root, font=("Times", 12), height=10, width=25)
+button11 = Button(root, text="LOW STOCK", bg="white", fg="black", width=20, font=("Times", 12), command=viewlowstock)
+status = Label(root, text="READY", bg="black", fg="white", font=("Times", 12))
+lagtext = Label(root, text="", bg="black", fg="white", font=("Times", 12))
+counttext = Label(root, text="", bg="black", fg="white", font=("Times", 12))
+pendingtext = Label(root, text="", bg="black", fg="white", font=("Times", 12))
+button13 = Button(root, text="DEBUG", bg="white", fg="black", width=20, font=("Times", 12), command=viewdebug)
+button12 = Button(root, text="SAVE NOW", bg="white", fg="black", width=20, font=("Times", 12), command=flushpending)
 label0.grid(columnspan=6, padx=10, pady=10)
 label1.grid(row=1, column=0, sticky=W, padx=10, pady=10)
 label2.grid(row=2, column=0, sticky=W, padx=10, pady=10)
@@ -231,4 +597,37 @@ button6.grid(row=3, column=5, padx=40, pady=10)
 button7.grid(row=4, column=4, padx=40, pady=10)
 button8.grid(row=4, column=5, padx=40, pady=10)
 button9.grid(row=5, column=5, padx=40, pady=10)
+button10.grid(row=5, column=4, padx=40, pady=10)
+suggestions.grid(row=1, column=2, rowspan=5, sticky=NS, padx=10, pady=10)
+entry1.bind("<KeyRelease>", suggestitem)
+suggestions.bind("<<ListboxSelect>>", picksuggestion)
+button11.grid(row=6, column=4, padx=40, pady=10)
+status.grid(row=6, column=0, sticky=W, padx=10, pady=10)
+lagtext.grid(row=6, column=5, sticky=E, padx=10, pady=10)
+counttext.grid(row=6, column=1, sticky=W, padx=10, pady=10)
+pendingtext.grid(row=7, column=0, sticky=W, padx=10, pady=10)
+button12.grid(row=7, column=4, padx=40, pady=10)
+button13.grid(row=7, column=5, padx=40, pady=10)
+
+
+def closewindow():
+    worker.shutdown()
+    try:
+        if pending:
+            store.add_many(pending)
+    except (OSError, ValueError):
+        messagebox.showinfo("Title", "COULD NOT SAVE PENDING ITEMS: " + ", ".join(fields[0] for fields in pending))
+    finally:
+        metrics.dump(METRICS_PATH)
+        store.close()
+        ledger.close()
+        root.destroy()
+
+
+root.protocol("WM_DELETE_WINDOW", closewindow)
+heartbeat(time.perf_counter())
+root.after(DUMP_INTERVAL, dumpmetrics)
+runstorage(countdone, len, store)
+if getattr(store, "recovered", None):
+    messagebox.showinfo("Title", "REPAIRS MADE WHILE OPENING THE INVENTORY:\n" + "\n".join(store.recovered))
 root.mainloop()
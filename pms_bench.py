@@ -0,0 +1,630 @@
+import csv
+import json
+import multiprocessing
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from array import array
+from queue import Empty
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import pms_report
+from pms_cli import run_batch
+from pms_ledger import ROW, Ledger
+from pms_shard import ShardedStore, shard_stock, split
+from pms_sqlite import migrate
+from pms_store import (FIELDS, InventoryStore, TextFormat, convert, file_signature, make_record, might_contain,
+                       open_store, save_snapshot)
+
+
+def make_rows(count):
+    for i in range(count):
+        yield "item%d" % i, 10 + i % 500, i % 1000, "cat%d" % (i % 50), i % 30
+
+
+def make_catalogue(path, count):
+    fmt = TextFormat()
+    with open(path, 'wb') as data:
+        for fields in make_rows(count):
+            data.write(fmt.encode(make_record(fields))[0][0])
+
+
+def bench_lookup(sizes, lookups=100000):
+    """Time exact item-name lookups against catalogues of growing size."""
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for count in sizes:
+            path = os.path.join(tmp, "database_proj_%d" % count)
+            make_catalogue(path, count)
+            store = InventoryStore(path)
+            keys = ["item%d" % random.randrange(count) for _ in range(lookups)]
+            start = time.perf_counter()
+            for key in keys:
+                store.search(key)
+            elapsed = time.perf_counter() - start
+            results.append((count, elapsed / lookups * 1e6))
+            print("%9d items: %.2f us per lookup" % results[-1])
+    return results
+
+
+def bench_bulk(count=1000000):
+    """Time a CSV import and export of count rows."""
+    with tempfile.TemporaryDirectory() as tmp:
+        feed = os.path.join(tmp, "feed.csv")
+        with open(feed, 'w', newline='') as dst:
+            writer = csv.writer(dst)
+            writer.writerow(FIELDS)
+            writer.writerows(make_rows(count))
+        store = InventoryStore(os.path.join(tmp, "database_proj"))
+        start = time.perf_counter()
+        store.import_csv(feed)
+        loaded = time.perf_counter() - start
+        start = time.perf_counter()
+        store.export_csv(os.path.join(tmp, "out.csv"))
+        dumped = time.perf_counter() - start
+        store.close()
+    print("import: %.0f rows/min, export: %.0f rows/min" % (count / loaded * 60, count / dumped * 60))
+    return loaded, dumped
+
+
+def bench_formats(count=1000000):
+    """Compare index load and full scan times of the text and binary formats."""
+    with tempfile.TemporaryDirectory() as tmp:
+        text_path = os.path.join(tmp, "database_proj")
+        binary_path = os.path.join(tmp, "database_proj.bin")
+        make_catalogue(text_path, count)
+        convert(text_path, binary_path, "binary")
+        for path in (text_path, binary_path):
+            os.remove(path + ".idx")
+            start = time.perf_counter()
+            store = InventoryStore(path)
+            loaded = time.perf_counter() - start
+            start = time.perf_counter()
+            for record in store.scan():
+                pass
+            scanned = time.perf_counter() - start
+            print("%-6s %6.1f MB  load %.2fs  scan %.2fs" % (
+                store.format.name, os.path.getsize(path) / 1e6, loaded, scanned))
+
+
+def bench_search(count=1000000, queries=1000):
+    """Time prefix completion and typo-tolerant search over count items."""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "database_proj")
+        make_catalogue(path, count)
+        start = time.perf_counter()
+        store = InventoryStore(path)
+        print("index build: %.2fs" % (time.perf_counter() - start))
+        names = ["item%d" % random.randrange(count) for _ in range(queries)]
+        typos = [name[:2] + name[3] + name[2] + name[4:] for name in names]
+        for label, func, keys in (("prefix", store.complete, [name[:6] for name in names]),
+                                  ("fuzzy", store.fuzzy, typos)):
+            worst = 0.0
+            start = time.perf_counter()
+            for key in keys:
+                began = time.perf_counter()
+                func(key)
+                worst = max(worst, time.perf_counter() - began)
+            elapsed = time.perf_counter() - start
+            print("%-6s %.3f ms mean, %.3f ms worst" % (label, elapsed / queries * 1000, worst * 1000))
+        store.close()
+
+
+def bench_range(count=1000000, queries=100):
+    """Time range queries through the sorted indexes against a full scan."""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "database_proj")
+        make_catalogue(path, count)
+        store = InventoryStore(path)
+        start = time.perf_counter()
+        store.below("quantity", 10)
+        print("first query (sorts the columns): %.2fs" % (time.perf_counter() - start))
+        for label, query, test in (
+                ("quantity < 10", lambda: store.below("quantity", 10), lambda r: r.quantity < 10),
+                ("100 <= price <= 101", lambda: store.between("price", 100, 101), lambda r: 100 <= r.price <= 101),
+                ("discount > 28", lambda: store.above("discount", 28), lambda r: r.discount > 28)):
+            start = time.perf_counter()
+            for _ in range(queries):
+                found = query()
+            indexed = (time.perf_counter() - start) / queries
+            start = time.perf_counter()
+            scanned = [record for record in store.scan() if test(record)]
+            scan = time.perf_counter() - start
+            assert len(found) == len(scanned)
+            print("%-20s %7d hits  index %8.2f ms  scan %8.2f ms" % (label, len(found), indexed * 1000, scan * 1000))
+        store.close()
+
+
+def bench_cache(count=100000, lookups=100000, hot=300):
+    """Skewed lookups, 90% on a few hundred hot items, with and without the cache."""
+    rng = random.Random(0)
+    hot_names = ["item%d" % rng.randrange(count) for _ in range(hot)]
+    keys = [rng.choice(hot_names) if rng.random() < 0.9 else "item%d" % rng.randrange(count)
+            for _ in range(lookups)]
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "database_proj")
+        make_catalogue(path, count)
+        for capacity in (0, 128, 1024, 8192):
+            store = InventoryStore(path, cache_size=capacity)
+            start = time.perf_counter()
+            for key in keys:
+                store.search(key)
+            elapsed = time.perf_counter() - start
+            stats = store.cache_stats()
+            store.close()
+            print("cache %5d: %6.2f us per search, %5.1f%% hits" % (
+                capacity, elapsed / lookups * 1e6, stats["hit_ratio"] * 100))
+
+
+def bench_bloom(count=1000000, probes=10000):
+    """Time answering misses from the on-disk Bloom filter versus opening the store."""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "database_proj")
+        make_catalogue(path, count)
+        InventoryStore(path).close()
+        misses = ["absent%d" % i for i in range(probes)]
+        start = time.perf_counter()
+        maybe = sum(might_contain(path, name) for name in misses)
+        probed = (time.perf_counter() - start) / probes
+        start = time.perf_counter()
+        store = InventoryStore(path)
+        opened = time.perf_counter() - start
+        start = time.perf_counter()
+        for name in misses:
+            store.search(name)
+        searched = (time.perf_counter() - start) / probes
+        store.close()
+    print("cold probe of the on-disk filter: %.1f us per miss, %.2f%% false positives" % (
+        probed * 1e6, maybe / probes * 100))
+    print("opening the store: %.2fs, then %.1f us per miss" % (opened, searched * 1e6))
+    return probed, opened
+
+
+def make_ops(count):
+    """A mixed script of count adds, updates, gets and deletes."""
+    for i in range(count):
+        kind = i % 10
+        if kind < 4:
+            yield "add item%d %d %d cat%d %d" % (i, 10 + i % 500, i % 1000, i % 50, i % 30)
+        elif kind < 7:
+            yield "get item%d" % (i - 4)
+        elif kind < 9:
+            yield "update item%d 12.5 %d cat%d 5" % (i - 7, i % 100, i % 50)
+        else:
+            yield "delete item%d" % (i - 9)
+
+
+def bench_ops(count=100000, durable=1):
+    """Drive count scripted operations through the storage API, no display."""
+    with tempfile.TemporaryDirectory() as tmp:
+        store = InventoryStore(os.path.join(tmp, "database_proj"), durable=bool(durable))
+        start = time.perf_counter()
+        done, failed = run_batch(store, make_ops(count))
+        store.sync()
+        elapsed = time.perf_counter() - start
+        store.close()
+    print("%d operations (%d failed) in %.2fs: %.0f ops/s" % (done, failed, elapsed, done / elapsed))
+    return done / elapsed
+
+
+def stress_writer(path, worker, count):
+    store = InventoryStore(path, compact_min=200, compact_ratio=0.3)
+    for i in range(count):
+        store.add(("w%d_%d" % (worker, i), 1, i, "cat%d" % worker, 0))
+        if i % 2:
+            store.update(("w%d_%d" % (worker, i - 1), 2, i, "cat%d" % worker, 0))
+        if i % 4 == 3:
+            store.delete("w%d_%d" % (worker, i - 3))
+        store.get("w%d_%d" % (worker, i))
+    store.close()
+
+
+def bench_stress(workers=8, count=500):
+    """Run concurrent writer processes on one store and check nothing was lost."""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "database_proj")
+        InventoryStore(path).close()
+        start = time.perf_counter()
+        procs = [multiprocessing.Process(target=stress_writer, args=(path, w, count)) for w in range(workers)]
+        for proc in procs:
+            proc.start()
+        for proc in procs:
+            proc.join()
+        elapsed = time.perf_counter() - start
+        expected = {}
+        for w in range(workers):
+            for i in range(count):
+                expected["w%d_%d" % (w, i)] = i
+                if i % 2:
+                    expected["w%d_%d" % (w, i - 1)] = i
+                if i % 4 == 3:
+                    del expected["w%d_%d" % (w, i - 3)]
+        store = InventoryStore(path)
+        found = {record.name: record.quantity for record in store.scan()}
+        ok = found == expected and all(p.exitcode == 0 for p in procs)
+        print("%d writers x %d items: %.2fs, %s" % (workers, count, elapsed, "ok" if ok else "MISMATCH"))
+        return ok
+
+
+def bench_commit(threads=8, count=1000, delay=0.0):
+    """Durable inserts/sec with one fsync per record versus group commit."""
+    results = {}
+    for label, batch in (("per-record fsync", 1), ("group commit", 256)):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = InventoryStore(os.path.join(tmp, "database_proj"), sync_delay=delay, sync_batch=batch)
+
+            def writer(t):
+                for i in range(count):
+                    store.add(("t%d_%d" % (t, i), 1, i, "cat", 0))
+
+            workers = [threading.Thread(target=writer, args=(t,)) for t in range(threads)]
+            start = time.perf_counter()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            elapsed = time.perf_counter() - start
+            batches = store.committer.batches if store.committer else threads * count
+            store.close()
+        results[label] = threads * count / elapsed
+        print("%-16s %9.0f durable inserts/s, %d fsyncs" % (label, results[label], batches))
+    return results
+
+
+def peak_rss_kb(children=False):
+    """Peak resident set size of this process in KB, None where unknown.
+
+    With children, the larger of that and the peak of its biggest waited-for child.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if children:
+        peak = max(peak, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def time_ops(func, calls):
+    """Call func(*args) for each args in calls; return throughput and latency."""
+    latencies = []
+    for args in calls:
+        start = time.perf_counter()
+        func(*args)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    total = sum(latencies)
+    return {
+        "ops": len(latencies),
+        "ops_per_sec": round(len(latencies) / total, 1) if total else None,
+        "p50_us": round(latencies[len(latencies) // 2] * 1e6, 1),
+        "p99_us": round(latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)] * 1e6, 1),
+    }
+
+
+def bench_size(count, ops=1000, fmt="text", seed=0):
+    """Time every store operation against one synthetic catalogue of count items."""
+    rng = random.Random(seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "database_proj")
+        make_catalogue(path, count)
+        if fmt == "sqlite":
+            migrate(path, path + ".db")
+            path += ".db"
+        elif fmt != "text":
+            convert(path, path + "." + fmt, fmt)
+            path += "." + fmt
+        start = time.perf_counter()
+        store = open_store(path)
+        result = {"items": count, "format": fmt, "open_s": round(time.perf_counter() - start, 3)}
+        names = ["item%d" % i for i in rng.sample(range(count), min(count, 2 * ops))]
+        changed, dropped = names[:ops], names[ops:]
+        spots = [rng.randrange(max(1, count - 1)) for _ in range(ops)]
+        result["search"] = time_ops(store.search, [(name,) for name in rng.sample(names, len(names))][:ops])
+        result["add"] = time_ops(store.add, [(("new%d" % i, 9.5, i, "new", 0),) for i in range(ops)])
+        result["update"] = time_ops(store.update, [((name, 11.0, 7, "cat1", 5),) for name in changed])
+        result["delete"] = time_ops(store.delete, [(name,) for name in dropped])
+        result["first"] = time_ops(store.first, [()] * ops)
+        result["next"] = time_ops(store.record, [(num,) for num in spots])
+        result["last"] = time_ops(store.last, [()] * ops)
+        start = time.perf_counter()
+        scanned = sum(1 for _ in store.scan())
+        elapsed = time.perf_counter() - start
+        result["scan"] = {"records": scanned, "seconds": round(elapsed, 3),
+                          "records_per_sec": round(scanned / elapsed, 1) if elapsed else None}
+        store.close()
+    result["peak_rss_kb"] = peak_rss_kb()
+    return result
+
+
+def bench_suite(sizes=(10000, 100000, 1000000), ops=1000, fmt="text"):
+    """Run bench_size for each size in a fresh process and return a JSON report.
+
+    A fresh process per size keeps peak RSS and the page cache state of
+    one catalogue from leaking into the next.
+    """
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "ops_per_size": ops,
+        "results": [],
+    }
+    for count in sizes:
+        print("benchmarking %d items..." % count, file=sys.stderr)
+        with multiprocessing.Pool(1) as pool:
+            report["results"].append(pool.apply(bench_size, (count, ops, fmt)))
+    return report
+
+
+def bench_shards(count=1000000, shards=8):
+    """Time a full stock report over one log versus shards scanned in parallel."""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "database_proj")
+        make_catalogue(path, count)
+        split(path, path + ".shards", shards)
+        start = time.perf_counter()
+        single = shard_stock(path)
+        alone = time.perf_counter() - start
+        store = ShardedStore(path + ".shards")
+        start = time.perf_counter()
+        merged = store.stock_report()
+        spread = time.perf_counter() - start
+        store.close()
+        assert {category: entry[1] for category, entry in single.items()} == {
+            category: entry[1] for category, entry in merged.items()}
+    print("one log: %.2fs, %d shards on %d cpus: %.2fs" % (alone, shards, os.cpu_count() or 1, spread))
+    return alone, spread
+
+
+def bench_ledger(rows=50000000, items=10000, queries=1000):
+    """Point-in-time stock queries on a ledger of rows movements.
+
+    Compares the checkpoint lookup with replaying the whole history, which
+    is what a ledger without checkpoints would have to do.
+    """
+    rng = random.Random(0)
+    kinds = ("receipt", "sale", "adjust")
+    with tempfile.TemporaryDirectory() as tmp:
+        ledger = Ledger(os.path.join(tmp, "database_proj.ledger"))
+        start = time.perf_counter()
+        batch = 1000000
+        for first in range(0, rows, batch):
+            ledger.append_many(("item%d" % rng.randrange(items), rng.randrange(-20, 50), kinds[i % 3], 1e9 + i)
+                               for i in range(first, min(rows, first + batch)))
+        loaded = time.perf_counter() - start
+        print("appended %d movements in %.1fs (%.0f rows/s), ledger %.0f MB + checkpoints %.0f MB" % (
+            rows, loaded, rows / loaded, os.path.getsize(ledger.path) / 1e6,
+            os.path.getsize(ledger.checkpoint_path) / 1e6))
+        asks = [("item%d" % rng.randrange(items), 1e9 + rng.randrange(rows)) for _ in range(queries)]
+        result = time_ops(ledger.stock_at, asks)
+        print("stock_at: %.0f queries/s, p50 %.0f us, p99 %.0f us" % (
+            result["ops_per_sec"], result["p50_us"], result["p99_us"]))
+        name, when = asks[0]
+        item = ledger.ids[name]
+        start = time.perf_counter()
+        stock = 0
+        with open(ledger.path, 'rb') as data:
+            for chunk in iter(lambda: data.read(ROW.size * 65536), b""):
+                for stamp, tag, delta in ROW.iter_unpack(chunk):
+                    if tag >> 2 == item and stamp <= when:
+                        stock += delta
+        replay = time.perf_counter() - start
+        assert stock == ledger.stock_at(name, when)
+        print("full history replay for one query: %.1fs" % replay)
+        ledger.close()
+    return result, replay
+
+
+def make_indexed_catalogue(path, count):
+    """make_catalogue plus the saved .idx snapshot, without loading a store."""
+    fmt = TextFormat()
+    offsets = array('Q')
+    size = 0
+    with open(path, 'wb') as data:
+        for fields in make_rows(count):
+            line = fmt.encode(make_record(fields))[0][0]
+            offsets.append(size)
+            data.write(line)
+            size += len(line)
+    save_snapshot(path + ".idx", size, file_signature(path, size), (count, offsets, None))
+
+
+def timed_valuation(path, workers, vectorized):
+    # runs in a freshly spawned process so its peak RSS is the report's alone
+    if not vectorized:
+        pms_report.numpy = None
+    start = time.perf_counter()
+    totals, overall = pms_report.valuation(path, workers)
+    return time.perf_counter() - start, peak_rss_kb(children=True), overall
+
+
+def valuation_child(results, path, workers, vectorized):
+    # a Process, not a Pool worker: those are daemonic and may not start the report's own workers
+    results.put(timed_valuation(path, workers, vectorized))
+
+
+def bench_valuation(count=10000000, workers=0):
+    """Time the valuation report on a count-item catalogue, with and without NumPy."""
+    workers = workers or os.cpu_count() or 1
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "database_proj")
+        make_indexed_catalogue(path, count)
+        print("catalogue %.0f MB" % (os.path.getsize(path) / 1e6))
+        runs = [(1, True), (workers, True), (1, False)] if pms_report.numpy is not None else [(1, False)]
+        results = []
+        context = multiprocessing.get_context("spawn")
+        for run_workers, vectorized in runs:
+            queue = context.Queue()
+            child = context.Process(target=valuation_child, args=(queue, path, run_workers, vectorized))
+            child.start()
+            while True:
+                try:
+                    seconds, peak, overall = queue.get(timeout=1)
+                    break
+                except Empty:
+                    if not child.is_alive():
+                        raise RuntimeError("valuation run exited with code %s" % child.exitcode)
+            child.join()
+            results.append(overall)
+            print("%-8s %2d workers: %6.1fs  %9.0f items/s  peak RSS %s KB" % (
+                "numpy" if vectorized else "records", run_workers, seconds, count / seconds, peak))
+        assert all(overall[:2] == results[0][:2] for overall in results)
+    return results
+
+
+CRASH_POINTS = ("compact-written", "compact-replaced", "snapshot-written", "levels-written")
+
+
+def crash_child(point, path):
+    # run with PMS_CRASH_AT=point: start the rewrite that point sits in and die there
+    store = InventoryStore(path, compact_min=10 ** 9)
+    if point.startswith("compact"):
+        store.compact()
+    elif point == "snapshot-written":
+        store.add(("late", 1, 1, "cat0", 0))
+        store.save_index()
+    else:
+        store.set_reorder(99, item="item1")
+    sys.exit("%s was never reached" % point)
+
+
+def crash_store(path, count):
+    """A log of count items with half deleted and one reorder level; returns the live records."""
+    store = InventoryStore(path, compact_min=10 ** 9)
+    store.import_rows(make_rows(count))
+    for num in range(0, count, 2):
+        store.delete("item%d" % num)
+    store.set_reorder(5, item="item1")
+    live = {record.name: record for record in store.scan()}
+    store.close()
+    return live
+
+
+def bench_crash(count=100000):
+    """Kill a process inside each rewrite, then check that the next open recovers.
+
+    Also times the rewrites with and without their fsyncs, the cost of
+    the crash-safe protocol.
+    """
+    failures = 0
+    for point in CRASH_POINTS + ("legacy",):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "database_proj")
+            live = crash_store(path, count)
+            if point == "legacy":
+                # the old PMS.py dying between its remove and rename
+                os.replace(path, path + "1")
+                code = 70
+            else:
+                code = subprocess.call([sys.executable, os.path.abspath(__file__), "crashchild", point, path],
+                                       env=dict(os.environ, PMS_CRASH_AT=point))
+            store = InventoryStore(path, compact_min=10 ** 9)
+            if point == "snapshot-written":
+                live["late"] = make_record(("late", 1, 1, "cat0", 0))
+            found = {record.name: record for record in store.scan()}
+            problems = []
+            if code != 70:
+                problems.append("child exited %r" % code)
+            if found != live:
+                problems.append("%d records differ" % len(set(found.items()) ^ set(live.items())))
+            if store.item_levels != {"item1": 5}:
+                problems.append("reorder levels %r" % store.item_levels)
+            prefix = "database_proj.compact"
+            leftover = [name for name in os.listdir(tmp) if name.endswith(".tmp") or name == "database_proj1"
+                        or name.startswith(prefix) and name[len(prefix):].isdigit()]
+            if leftover:
+                problems.append("left behind %s" % ", ".join(leftover))
+            print("%-18s %s  %s" % (point, "FAIL" if problems else "ok  ", "; ".join(problems or store.recovered)))
+            failures += bool(problems)
+            store.close()
+
+    real_fsync = os.fsync
+    for synced in (True, False):
+        if not synced:
+            os.fsync = lambda fd: None
+        try:
+            with tempfile.TemporaryDirectory() as tmp:
+                path = os.path.join(tmp, "database_proj")
+                crash_store(path, count)
+                store = InventoryStore(path, compact_min=10 ** 9)
+                start = time.perf_counter()
+                store.compact()
+                compact = time.perf_counter() - start
+                start = time.perf_counter()
+                store.save_index()
+                snapshot = time.perf_counter() - start
+                levels = time_ops(store.set_reorder, [(num % 50, "item%d" % num) for num in range(1, 400, 2)])
+                store.close()
+        finally:
+            os.fsync = real_fsync
+        print("%-10s compact %d items %.3fs, save_index %.3fs, set_reorder %.0f/s" % (
+            "fsync" if synced else "no fsync", count // 2, compact, snapshot, levels["ops_per_sec"]))
+    return failures
+
+
+def bench_backends(count=100000, ops=1000):
+    """Compare the text log, binary log and SQLite backends on one catalogue size."""
+    rows = []
+    for fmt in ("text", "binary", "sqlite"):
+        with multiprocessing.Pool(1) as pool:
+            rows.append(pool.apply(bench_size, (count, ops, fmt)))
+    print("%-12s" % ("%d items" % count) + "".join("%12s" % row["format"] for row in rows))
+    print("%-12s" % "open s" + "".join("%12.3f" % row["open_s"] for row in rows))
+    for op in ("search", "add", "update", "delete", "first", "next", "last"):
+        print("%-12s" % (op + " ops/s") + "".join("%12.0f" % row[op]["ops_per_sec"] for row in rows))
+    print("%-12s" % "scan rec/s" + "".join("%12.0f" % row["scan"]["records_per_sec"] for row in rows))
+    print("%-12s" % "peak RSS MB" + "".join("%12.1f" % ((row["peak_rss_kb"] or 0) / 1024) for row in rows))
+    return rows
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["bulk"]:
+        bench_bulk(*[int(n) for n in sys.argv[2:3]])
+    elif sys.argv[1:2] == ["stress"]:
+        sys.exit(0 if bench_stress(*[int(n) for n in sys.argv[2:4]]) else 1)
+    elif sys.argv[1:2] == ["commit"]:
+        bench_commit(*[int(n) for n in sys.argv[2:4]])
+    elif sys.argv[1:2] == ["search"]:
+        bench_search(*[int(n) for n in sys.argv[2:4]])
+    elif sys.argv[1:2] == ["range"]:
+        bench_range(*[int(n) for n in sys.argv[2:4]])
+    elif sys.argv[1:2] == ["ops"]:
+        bench_ops(*[int(n) for n in sys.argv[2:4]])
+    elif sys.argv[1:2] == ["suite"]:
+        # pms_bench.py suite [size ...] > report.json; PMS_BENCH_OPS and
+        # PMS_BENCH_FORMAT override the operations per size and file format
+        sizes = [int(n) for n in sys.argv[2:]] or [10000, 100000, 1000000]
+        report = bench_suite(sizes, int(os.environ.get("PMS_BENCH_OPS", 1000)),
+                             os.environ.get("PMS_BENCH_FORMAT", "text"))
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    elif sys.argv[1:2] == ["cache"]:
+        bench_cache(*[int(n) for n in sys.argv[2:5]])
+    elif sys.argv[1:2] == ["bloom"]:
+        bench_bloom(*[int(n) for n in sys.argv[2:4]])
+    elif sys.argv[1:2] == ["backends"]:
+        bench_backends(*[int(n) for n in sys.argv[2:4]])
+    elif sys.argv[1:2] == ["shards"]:
+        bench_shards(*[int(n) for n in sys.argv[2:4]])
+    elif sys.argv[1:2] == ["ledger"]:
+        bench_ledger(*[int(n) for n in sys.argv[2:5]])
+    elif sys.argv[1:2] == ["valuation"]:
+        bench_valuation(*[int(n) for n in sys.argv[2:4]])
+    elif sys.argv[1:2] == ["crash"]:
+        sys.exit(1 if bench_crash(*[int(n) for n in sys.argv[2:3]]) else 0)
+    elif sys.argv[1:2] == ["crashchild"]:
+        crash_child(*sys.argv[2:4])
+    elif sys.argv[1:2] == ["formats"]:
+        bench_formats(*[int(n) for n in sys.argv[2:3]])
+    else:
+        sizes = [int(n) for n in sys.argv[1:]] or [10000, 100000, 1000000]
+        bench_lookup(sizes)
@@ -0,0 +1,318 @@
+import argparse
+import json
+import sys
+import time
+from datetime import datetime
+
+from pms_ledger import Ledger
+from pms_report import file_snapshot, valuation
+from pms_shard import split
+from pms_sqlite import migrate
+from pms_store import DATA_FILE, FORMATS, InventoryStore, convert, might_contain, open_store
+
+
+def cmd_add(store, args):
+    store.add(args.fields)
+
+
+def cmd_update(store, args):
+    store.update(args.fields)
+
+
+def cmd_delete(store, args):
+    store.delete(args.name)
+
+
+def cmd_get(store, args):
+    print(*store.get(args.name))
+
+
+def cmd_search(store, args):
+    if args.prefix:
+        names = store.complete(args.text, args.limit)
+    elif args.fuzzy:
+        names = store.fuzzy(args.text, args.limit)
+    else:
+        found = store.search(args.text)
+        names = [found[1].name] if found else []
+    for name in names:
+        print(*store.get(name))
+    return 0 if names else 1
+
+
+def cmd_scan(store, args):
+    for record in store.scan():
+        print(*record)
+
+
+def run_batch(store, lines):
+    """Apply 'add|update FIELDS', 'delete NAME' and 'get NAME' lines.
+
+    Returns (operations, failures); a failure is an unknown or missing
+    item, a duplicate add or a malformed line.
+    """
+    operations = {"add": store.add, "update": store.update, "delete": store.delete, "get": store.get}
+    done = failed = 0
+    for line in lines:
+        words = line.split()
+        if not words:
+            continue
+        done += 1
+        try:
+            operation = operations[words[0]]
+            operation(words[1:] if words[0] in ("add", "update") else words[1])
+        except (KeyError, ValueError, IndexError) as exc:
+            failed += 1
+            print("line %d: %s failed: %r" % (done, words[0], exc), file=sys.stderr)
+    return done, failed
+
+
+def cmd_batch(store, args):
+    start = time.perf_counter()
+    if args.ops == "-":
+        done, failed = run_batch(store, sys.stdin)
+    else:
+        with open(args.ops) as src:
+            done, failed = run_batch(store, src)
+    store.sync()
+    elapsed = time.perf_counter() - start
+    print("%d operations, %d failed, in %.2fs (%.0f ops/s)" % (done, failed, elapsed, done / max(elapsed, 1e-9)))
+    if hasattr(store, "cache_stats"):
+        stats = store.cache_stats()
+        print("record cache: %d hits, %d misses (%.1f%% hit), %d of %d held" % (
+            stats["hits"], stats["misses"], stats["hit_ratio"] * 100, stats["size"], stats["capacity"]))
+    return 1 if failed else 0
+
+
+def parse_time(text):
+    """Seconds since the epoch, or an ISO date and time such as 2026-10-18T09:30."""
+    try:
+        return float(text)
+    except ValueError:
+        return datetime.fromisoformat(text).timestamp()
+
+
+def cmd_move(store, args):
+    delta = -args.quantity if args.kind == "sale" else args.quantity
+    store.move(args.name, delta, args.kind)
+
+
+def cmd_stock(store, args):
+    print(args.ledger.stock_at(args.name, args.at))
+
+
+def cmd_history(store, args):
+    for when, kind, delta in args.ledger.history(args.name, args.since, args.until):
+        print("%s %-8s %+d" % (datetime.fromtimestamp(when).isoformat(timespec="seconds"), kind, delta))
+
+
+def cmd_import(store, args):
+    start = time.perf_counter()
+    count = store.import_csv(args.csv, header=not args.no_header, batch_size=args.batch)
+    elapsed = time.perf_counter() - start
+    print("imported %d rows in %.2fs (%.0f rows/min)" % (count, elapsed, count / max(elapsed, 1e-9) * 60))
+
+
+def cmd_export(store, args):
+    count = store.export_csv(args.csv, header=not args.no_header)
+    print("exported %d rows" % count)
+
+
+def cmd_convert(store, args):
+    if not isinstance(store, InventoryStore):
+        print("convert copies from a database_proj log; %s is not one" % args.db, file=sys.stderr)
+        return 1
+    if args.format == "sqlite":
+        count = migrate(args.db, args.dst)
+    elif args.format == "shards":
+        count = split(args.db, args.dst, args.shards)
+    else:
+        count = convert(args.db, args.dst, args.format)
+    print("converted %d records to %s" % (count, args.format))
+
+
+def cmd_categories(store, args):
+    for category, (value, items, discounted) in sorted(store.category_totals().items()):
+        print("%-20s %14.2f %8d items %8d discounted" % (category, value, items, discounted))
+
+
+def cmd_report(store, args):
+    # sharded stores scan their shards in parallel
+    start = time.perf_counter()
+    if hasattr(store, "stock_report"):
+        totals = store.stock_report(args.workers)
+    else:
+        totals = store.category_totals()
+    for category, (value, items, discounted) in sorted(totals.items()):
+        print("%-20s %14.2f %8d items %8d discounted" % (category, value, items, discounted))
+    print("%d categories in %.2fs" % (len(totals), time.perf_counter() - start), file=sys.stderr)
+
+
+def cmd_valuation(store, args):
+    start = time.perf_counter()
+    totals, overall = valuation(store, args.workers)
+    if args.json:
+        fields = ("items", "units", "gross", "value")
+        categories = {category: dict(zip(fields, entry)) for category, entry in sorted(totals.items())}
+        print(json.dumps({"categories": categories, "total": dict(zip(fields, overall))}, indent=2))
+    else:
+        for category, (items, units, gross, value) in sorted(totals.items()) + [("TOTAL", overall)]:
+            print("%-20s %8d items %10d units %16.2f gross %16.2f value" % (category, items, units, gross, value))
+    print("%d categories in %.2fs" % (len(totals), time.perf_counter() - start), file=sys.stderr)
+
+
+def cmd_category(store, args):
+    for record in store.in_category(args.category):
+        print(*record)
+
+
+def cmd_where(store, args):
+    if args.between:
+        records = store.between(args.field, *args.between)
+    elif args.below is not None:
+        records = store.below(args.field, args.below)
+    else:
+        records = store.above(args.field, args.above)
+    for record in records:
+        print(*record)
+
+
+def cmd_lowstock(store, args):
+    for record, level in store.low_stock():
+        print("%-30s %8d of %8d  %s" % (record.name, record.quantity, level, record.category))
+
+
+def cmd_reorder(store, args):
+    store.set_reorder(args.level, item=args.item, category=args.category)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Headless tools for the pharmacy inventory.")
+    parser.add_argument("--db", default=DATA_FILE, help="inventory data file")
+    parser.add_argument("--cache", type=int, default=1024, help="records held in the lookup cache")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    for name, func in (("add", cmd_add), ("update", cmd_update)):
+        change = commands.add_parser(name, help="%s one item" % name)
+        change.add_argument("fields", nargs=5, metavar=("NAME", "PRICE", "QUANTITY", "CATEGORY", "DISCOUNT"))
+        change.set_defaults(func=func)
+
+    for name, func, text in (("delete", cmd_delete, "delete one item"), ("get", cmd_get, "print one item")):
+        one = commands.add_parser(name, help=text)
+        one.add_argument("name")
+        one.set_defaults(func=func)
+
+    find = commands.add_parser("search", help="find items by exact name, prefix or near spelling")
+    find.add_argument("text")
+    how = find.add_mutually_exclusive_group()
+    how.add_argument("--prefix", action="store_true")
+    how.add_argument("--fuzzy", action="store_true")
+    find.add_argument("--limit", type=int, default=10)
+    find.set_defaults(func=cmd_search)
+
+    scan = commands.add_parser("scan", help="print every item in file order")
+    scan.set_defaults(func=cmd_scan)
+
+    batch = commands.add_parser("batch", help="apply add/update/delete/get lines from a file, - for stdin")
+    batch.add_argument("ops")
+    batch.set_defaults(func=cmd_batch)
+
+    for kind, text in (("receipt", "receive stock of an item"), ("sale", "sell stock of an item"),
+                       ("adjust", "correct the stock of an item by a signed amount")):
+        move = commands.add_parser(kind, help=text)
+        move.add_argument("name")
+        move.add_argument("quantity", type=int)
+        move.set_defaults(func=cmd_move, kind=kind)
+
+    stock = commands.add_parser("stock", help="units of an item in stock, now or at a past time")
+    stock.add_argument("name")
+    stock.add_argument("--at", type=parse_time, help="epoch seconds or ISO time")
+    stock.set_defaults(func=cmd_stock)
+
+    history = commands.add_parser("history", help="stock movements of an item")
+    history.add_argument("name")
+    history.add_argument("--since", type=parse_time)
+    history.add_argument("--until", type=parse_time)
+    history.set_defaults(func=cmd_history)
+
+    load = commands.add_parser("import", help="load or replace items from a CSV file")
+    load.add_argument("csv")
+    load.add_argument("--no-header", action="store_true")
+    load.add_argument("--batch", type=int, default=50000, help="rows per write")
+    load.set_defaults(func=cmd_import)
+
+    dump = commands.add_parser("export", help="write every item to a CSV file")
+    dump.add_argument("csv")
+    dump.add_argument("--no-header", action="store_true")
+    dump.set_defaults(func=cmd_export)
+
+    conv = commands.add_parser("convert", help="copy the live records into a new file")
+    conv.add_argument("dst")
+    conv.add_argument("--format", choices=sorted(FORMATS) + ["shards", "sqlite"], default="binary")
+    conv.add_argument("--shards", type=int, default=8, help="shard count for --format shards")
+    conv.set_defaults(func=cmd_convert)
+
+    totals = commands.add_parser("categories", help="stock value and item counts per category")
+    totals.set_defaults(func=cmd_categories)
+
+    report = commands.add_parser("report", help="stock valuation per category, scanning shards in parallel")
+    report.add_argument("--workers", type=int, help="worker processes for a sharded store")
+    report.set_defaults(func=cmd_report)
+
+    value = commands.add_parser("valuation", help="stock value per category and overall, after discounts")
+    value.add_argument("--workers", type=int, default=1, help="worker processes sharing the scan")
+    value.add_argument("--json", action="store_true", help="print the totals as JSON")
+    value.set_defaults(func=cmd_valuation)
+
+    members = commands.add_parser("category", help="list the items in one category")
+    members.add_argument("category")
+    members.set_defaults(func=cmd_category)
+
+    where = commands.add_parser("where", help="list the items with a numeric field in a range")
+    where.add_argument("field", choices=("price", "quantity", "discount"))
+    bounds = where.add_mutually_exclusive_group(required=True)
+    bounds.add_argument("--below", type=float, help="strictly less than")
+    bounds.add_argument("--above", type=float, help="strictly greater than")
+    bounds.add_argument("--between", type=float, nargs=2, metavar=("LOW", "HIGH"), help="inclusive range")
+    where.set_defaults(func=cmd_where)
+
+    low = commands.add_parser("lowstock", help="list the items at or below their reorder level")
+    low.set_defaults(func=cmd_lowstock)
+
+    reorder = commands.add_parser("reorder", help="set the reorder level of an item or category")
+    reorder.add_argument("level", type=int, nargs="?", help="leave out to clear the level")
+    target = reorder.add_mutually_exclusive_group(required=True)
+    target.add_argument("--item")
+    target.add_argument("--category")
+    reorder.set_defaults(func=cmd_reorder)
+
+    args = parser.parse_args(argv)
+    exact = args.func is cmd_get or (args.func is cmd_search and not args.prefix and not args.fuzzy)
+    if exact:
+        # the Bloom filter answers most misses without loading the indexes
+        name = args.name if args.func is cmd_get else args.text
+        if not might_contain(args.db, name):
+            print("no such item: %r" % name, file=sys.stderr)
+            return 1
+    if args.func is cmd_valuation and file_snapshot(args.db) is not None:
+        # a current saved index is all the report needs; skip loading the store
+        return cmd_valuation(args.db, args)
+    args.ledger = Ledger(args.db + ".ledger")
+    store = open_store(args.db, cache_size=args.cache, ledger=args.ledger)
+    for repair in getattr(store, "recovered", []):
+        print("recovered: %s" % repair, file=sys.stderr)
+    try:
+        return args.func(store, args)
+    except KeyError as exc:
+        print("no such item or item already exists: %s" % exc, file=sys.stderr)
+        return 1
+    except ValueError as exc:
+        print("invalid item details: %s" % exc, file=sys.stderr)
+        return 1
+    finally:
+        store.close()
+        args.ledger.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,398 @@
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from collections import Counter
+from hashlib import blake2b
+from math import log
+
+
+class CategoryIndex:
+    """Item names per category with running stock totals.
+
+    totals maps a category to [stock value, item count, discounted item
+    count], where stock value is the sum of price * quantity. apply() keeps
+    everything current as records are added, replaced and deleted.
+    """
+
+    suffix = "cat"
+
+    def __init__(self):
+        self.items = {}
+        self.members = {}
+        self.totals = {}
+
+    def apply(self, name, record):
+        old = self.items.pop(name, None)
+        if old is not None:
+            category, value, discounted = old
+            totals = self.totals[category]
+            totals[0] -= value
+            totals[1] -= 1
+            totals[2] -= discounted
+            self.members[category].discard(name)
+            if not totals[1]:
+                del self.totals[category]
+                del self.members[category]
+        if record is not None:
+            category = record.category
+            value = record.price * record.quantity
+            discounted = 1 if record.discount > 0 else 0
+            self.items[name] = (category, value, discounted)
+            totals = self.totals.setdefault(category, [0.0, 0, 0])
+            totals[0] += value
+            totals[1] += 1
+            totals[2] += discounted
+            self.members.setdefault(category, set()).add(name)
+
+    def names(self, category):
+        return sorted(self.members.get(category, ()))
+
+    def summary(self):
+        """Return {category: (stock value, items, discounted items)}."""
+        return {category: tuple(totals) for category, totals in self.totals.items()}
+
+    def state(self):
+        return self.items
+
+    def restore(self, items):
+        # totals are summed again rather than trusted from disk
+        for name, (category, value, discounted) in items.items():
+            self.items[name] = (category, value, discounted)
+            totals = self.totals.setdefault(category, [0.0, 0, 0])
+            totals[0] += value
+            totals[1] += 1
+            totals[2] += discounted
+            self.members.setdefault(category, set()).add(name)
+
+
+def trigrams(text):
+    """Return the set of three-letter pieces of text, case folded and padded."""
+    text = "  " + text.casefold() + " "
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class NameIndex:
+    """Item names for prefix completion and typo-tolerant search.
+
+    ordered keeps every name sorted by its case-folded spelling, so a
+    prefix is one bisect followed by a short walk; names added since the
+    last query are sorted in first. grams maps each trigram
+    to an array of name ids; a fuzzy query counts the ids shared by the
+    query's rarest trigrams and ranks the best candidates by similarity.
+    Deleted names leave a hole in names until the ids are renumbered.
+    """
+
+    suffix = "names"
+    CANDIDATES = 200
+    POSTINGS = 50000
+
+    def __init__(self):
+        self.ids = {}
+        self.names = []
+        self.ordered = []
+        self.added = []
+        self.grams = {}
+
+    def apply(self, name, record):
+        # an update keeps the name, so only adds and deletes change anything
+        if record is None:
+            num = self.ids.pop(name, None)
+            if num is None:
+                return
+            self.names[num] = None
+            self._settle()
+            i = bisect_left(self.ordered, name.casefold(), key=str.casefold)
+            while self.ordered[i] != name:
+                i += 1
+            del self.ordered[i]
+            if len(self.names) > 1000 and len(self.names) > 2 * len(self.ids):
+                self._renumber()
+        elif name not in self.ids:
+            self._add(name)
+            self.added.append(name)
+
+    def _add(self, name):
+        num = len(self.names)
+        self.ids[name] = num
+        self.names.append(name)
+        for gram in trigrams(name):
+            postings = self.grams.get(gram)
+            if postings is None:
+                postings = self.grams[gram] = array('I')
+            postings.append(num)
+
+    def _settle(self):
+        # new names are sorted in on the next query, in one pass if many
+        if len(self.added) > 64:
+            self.ordered += self.added
+            self.ordered.sort(key=str.casefold)
+        else:
+            for name in self.added:
+                insort(self.ordered, name, key=str.casefold)
+        self.added = []
+
+    def _renumber(self):
+        live = [name for name in self.names if name is not None]
+        self.ids, self.names, self.grams = {}, [], {}
+        for name in live:
+            self._add(name)
+
+    def prefix(self, text, limit=10):
+        """Return up to limit names starting with text, in name order."""
+        self._settle()
+        folded = text.casefold()
+        i = bisect_left(self.ordered, folded, key=str.casefold)
+        found = []
+        for name in self.ordered[i:i + limit]:
+            if not name.casefold().startswith(folded):
+                break
+            found.append(name)
+        return found
+
+    def fuzzy(self, text, limit=10, cutoff=0.3):
+        """Return up to limit names similar to text, best match first."""
+        wanted = trigrams(text)
+        postings = sorted((self.grams[gram] for gram in wanted if gram in self.grams), key=len)
+        if not postings:
+            return []
+        # very common trigrams say little and cost the most: skip them once
+        # the rarer ones have produced candidates, and cap the walk when
+        # the query has nothing but common ones
+        shared = Counter()
+        for ids in postings:
+            if len(ids) > self.POSTINGS and shared:
+                break
+            shared.update(ids[:self.POSTINGS])
+        scored = []
+        for num, _ in shared.most_common(self.CANDIDATES):
+            name = self.names[num]
+            if name is None:
+                continue
+            grams = trigrams(name)
+            score = len(wanted & grams) / len(wanted | grams)
+            if score >= cutoff:
+                scored.append((-score, name))
+        scored.sort()
+        return [name for _, name in scored[:limit]]
+
+    def state(self):
+        self._settle()
+        return self.names, self.ordered, self.grams
+
+    def restore(self, state):
+        self.names, self.ordered, self.grams = state
+        self.ids = {name: num for num, name in enumerate(self.names) if name is not None}
+
+
+class RangeIndex:
+    """Sorted price, quantity and discount columns for range queries.
+
+    For each field, values holds every item's value in ascending order and
+    names the matching item names, ties in name order. A query is two
+    bisects and a slice. Single changes are moved into place as they come;
+    after more than a few dozen at once, as in a replay or bulk load, the
+    columns are sorted again from items on the next query.
+    """
+
+    suffix = "range"
+    FIELDS = ("price", "quantity", "discount")
+
+    def __init__(self):
+        self.items = {}
+        self.columns = {field: (array('d'), []) for field in self.FIELDS}
+        self.changes = []
+        self.stale = False
+
+    def apply(self, name, record):
+        old = self.items.pop(name, None)
+        new = None
+        if record is not None:
+            new = self.items[name] = (record.price, record.quantity, record.discount)
+        if old == new or self.stale:
+            return
+        self.changes.append((name, old, new))
+        if len(self.changes) > 64:
+            self.stale = True
+            self.changes = []
+
+    def _settle(self):
+        if self.stale:
+            items = self.items
+            order = sorted(items)
+            for num, field in enumerate(self.FIELDS):
+                # a stable sort by value keeps ties in name order
+                names = sorted(order, key=lambda name: items[name][num])
+                self.columns[field] = (array('d', [items[name][num] for name in names]), names)
+            self.stale = False
+        for name, old, new in self.changes:
+            for num, field in enumerate(self.FIELDS):
+                values, names = self.columns[field]
+                if old is not None:
+                    i = self._find(values, names, old[num], name)
+                    del values[i]
+                    del names[i]
+                if new is not None:
+                    i = self._find(values, names, new[num], name)
+                    values.insert(i, new[num])
+                    names.insert(i, name)
+        self.changes = []
+
+    @staticmethod
+    def _find(values, names, value, name):
+        lo = bisect_left(values, value)
+        return bisect_left(names, name, lo, bisect_right(values, value, lo))
+
+    def between(self, field, low=None, high=None, low_open=False, high_open=False):
+        """Return the names with low <= field value <= high, by value.
+
+        Either bound may be None for no limit; low_open and high_open make
+        that end strict.
+        """
+        self._settle()
+        values, names = self.columns[field]
+        start, stop = 0, len(values)
+        if low is not None:
+            start = (bisect_right if low_open else bisect_left)(values, low)
+        if high is not None:
+            stop = (bisect_left if high_open else bisect_right)(values, high, start)
+        return names[start:stop]
+
+    def state(self):
+        self._settle()
+        return self.items, self.columns
+
+    def restore(self, state):
+        self.items, self.columns = state
+
+
+class LowStockIndex:
+    """The items at or below their reorder level, kept current per change.
+
+    An item's level is its own if one is set, otherwise its category's.
+    low maps each item at or below its level to that level; an add, update
+    or delete rechecks only the item concerned. Changing a category level
+    rechecks that category's members.
+    """
+
+    suffix = "low"
+
+    def __init__(self, item_levels=None, category_levels=None):
+        self.item_levels = {} if item_levels is None else item_levels
+        self.category_levels = {} if category_levels is None else category_levels
+        self.items = {}
+        self.members = {}
+        self.low = {}
+
+    def level(self, name, category):
+        level = self.item_levels.get(name)
+        if level is None:
+            level = self.category_levels.get(category)
+        return level
+
+    def _check(self, name):
+        category, quantity = self.items[name]
+        level = self.level(name, category)
+        if level is not None and quantity <= level:
+            self.low[name] = level
+        else:
+            self.low.pop(name, None)
+
+    def apply(self, name, record):
+        old = self.items.pop(name, None)
+        if old is not None and old[0] != getattr(record, "category", None):
+            members = self.members[old[0]]
+            members.discard(name)
+            if not members:
+                del self.members[old[0]]
+        if record is None:
+            self.low.pop(name, None)
+            return
+        self.items[name] = (record.category, record.quantity)
+        self.members.setdefault(record.category, set()).add(name)
+        self._check(name)
+
+    def set_level(self, level, item=None, category=None):
+        """Set or, with level None, clear the reorder level of an item or category."""
+        if item is not None:
+            levels, key, names = self.item_levels, item, [item] if item in self.items else []
+        else:
+            levels, key, names = self.category_levels, category, self.members.get(category, ())
+        if level is None:
+            levels.pop(key, None)
+        else:
+            levels[key] = level
+        for name in names:
+            self._check(name)
+
+    def retune(self, item_levels, category_levels):
+        # levels changed elsewhere, recheck every item held in memory
+        self.item_levels = item_levels
+        self.category_levels = category_levels
+        self.low = {}
+        for name in self.items:
+            self._check(name)
+
+    def state(self):
+        return self.items
+
+    def restore(self, items):
+        self.items = items
+        for name, (category, quantity) in items.items():
+            self.members.setdefault(category, set()).add(name)
+        self.retune(self.item_levels, self.category_levels)
+
+
+class BloomIndex:
+    """Bloom filter over the item names, sized for capacity at error rate.
+
+    A name that is not in the filter is certainly not in the store. Deleted
+    names stay set until the filter is rebuilt from the live names, which
+    the store does after compaction and whenever count outgrows capacity.
+    count is the number of names added that set at least one new bit.
+    """
+
+    suffix = "bloom"
+
+    def __init__(self, capacity=1024, error=0.01):
+        self.capacity = capacity
+        self.error = error
+        self.size = max(64, int(-capacity * log(error) / log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, name):
+        digest = blake2b(name.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        step = int.from_bytes(digest[8:], "little") | 1
+        return [(first + i * step) % self.size for i in range(self.hashes)]
+
+    def add(self, name):
+        bits = self.bits
+        fresh = False
+        for pos in self._positions(name):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                bits[pos >> 3] |= 1 << (pos & 7)
+                fresh = True
+        self.count += fresh
+
+    def __contains__(self, name):
+        bits = self.bits
+        return all(bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(name))
+
+    def apply(self, name, record):
+        if record is not None:
+            self.add(name)
+
+    def overfull(self):
+        return self.count > self.capacity
+
+    def rebuild(self, names):
+        self.__init__(max(1024, 2 * len(names)), self.error)
+        for name in names:
+            self.add(name)
+
+    def state(self):
+        return self.capacity, self.error, self.size, self.hashes, self.bits, self.count
+
+    def restore(self, state):
+        self.capacity, self.error, self.size, self.hashes, self.bits, self.count = state
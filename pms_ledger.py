@@ -0,0 +1,295 @@
+import mmap
+import os
+import struct
+import threading
+import time
+from array import array
+from bisect import bisect_right
+
+from pms_store import FileLock
+
+# timestamp, item id << 2 | kind, signed quantity change
+ROW = struct.Struct("<dIi")
+CHECKPOINT = struct.Struct("<QQ")
+KINDS = ("receipt", "sale", "adjust")
+
+
+class Ledger:
+    """Append-only log of stock movements with periodic stock checkpoints.
+
+    Every receipt, sale or adjustment is one fixed-size row, so row n sits
+    at n * ROW.size and rows can be bisected by timestamp, which never goes
+    backwards. Item names are interned in the .items file, one per line,
+    the line number being the id.
+
+    Every so often the stock of every item is written to the .ckpt file as
+    one array, headed by the row count it was taken at. The stock of an
+    item at a time is then one read from the checkpoint before it plus a
+    replay of the rows since, whatever the length of the history. A
+    checkpoint is taken once checkpoint_every rows, or as many rows as
+    there are items if that is more, have followed the last one. So the
+    8 bytes a checkpoint keeps per item add at most half the ledger's
+    size again, however many items there are.
+
+    Appends hold an exclusive lock on the .lock file, so several processes
+    may write one ledger; readers pick up their rows on the next query.
+    """
+
+    def __init__(self, path, checkpoint_every=16384):
+        self.path = path
+        self.names_path = path + ".items"
+        self.checkpoint_path = path + ".ckpt"
+        self.every = checkpoint_every
+        self.lock = threading.RLock()
+        self.file_lock = FileLock(path + ".lock")
+        self.ids = {}
+        self.names = []
+        self.names_size = 0
+        self.rows = 0
+        self.last_time = 0.0
+        self.stock = array('q')
+        # (rows before it, file offset, item count) of every checkpoint, oldest first
+        self.checkpoints = [(0, 0, 0)]
+        self.checkpoints_size = 0
+        self.view = None
+        with self.file_lock:
+            for name in (self.path, self.names_path, self.checkpoint_path):
+                open(name, 'ab').close()
+            # drop whatever a crash mid-append left torn
+            size = os.path.getsize(self.path)
+            if size % ROW.size:
+                os.truncate(self.path, size - size % ROW.size)
+            with open(self.names_path, 'rb') as names:
+                whole = names.read().rfind(b"\n") + 1
+            os.truncate(self.names_path, whole)
+            self.data = open(self.path, 'ab')
+            self.reader = open(self.path, 'rb')
+            self.checkpoint_file = open(self.checkpoint_path, 'a+b')
+            self.names_file = open(self.names_path, 'a+b')
+            self._load_checkpoints()
+            rows = os.path.getsize(self.path) // ROW.size
+            while self.checkpoints[-1][0] > rows:
+                # a checkpoint that outlived its rows
+                self.checkpoints_size = self.checkpoints.pop()[1] - CHECKPOINT.size
+            os.truncate(self.checkpoint_path, self.checkpoints_size)
+            self.refresh()
+
+    def refresh(self):
+        """Catch up with names, rows and checkpoints other processes appended."""
+        with self.lock:
+            self.names_file.seek(self.names_size)
+            for line in self.names_file:
+                if not line.endswith(b"\n"):
+                    break
+                self.ids[line[:-1].decode()] = len(self.names)
+                self.names.append(line[:-1].decode())
+                self.names_size += len(line)
+            self._load_checkpoints()
+            rows = os.fstat(self.reader.fileno()).st_size // ROW.size
+            if rows > self.rows:
+                view = self.mapped()
+                num = self._checkpoint_at(rows)
+                if self.checkpoints[num][0] > self.rows:
+                    # far behind: start from the newest checkpoint
+                    self.stock = self._checkpoint(num)
+                    self.rows = self.checkpoints[num][0]
+                for when, tag, delta in ROW.iter_unpack(view[self.rows * ROW.size:rows * ROW.size]):
+                    self._count(tag >> 2, delta)
+                self.rows = rows
+                self.last_time = ROW.unpack_from(view, (rows - 1) * ROW.size)[0]
+
+    def _load_checkpoints(self):
+        size = os.fstat(self.checkpoint_file.fileno()).st_size
+        while self.checkpoints_size + CHECKPOINT.size <= size:
+            self.checkpoint_file.seek(self.checkpoints_size)
+            rows, count = CHECKPOINT.unpack(self.checkpoint_file.read(CHECKPOINT.size))
+            end = self.checkpoints_size + CHECKPOINT.size + 8 * count
+            if end > size or rows <= self.checkpoints[-1][0]:
+                break
+            self.checkpoints.append((rows, self.checkpoints_size + CHECKPOINT.size, count))
+            self.checkpoints_size = end
+
+    def _checkpoint_at(self, row):
+        # the newest checkpoint taken at or before row
+        return bisect_right(self.checkpoints, (row, float("inf"))) - 1
+
+    def _checkpoint(self, num):
+        rows, offset, count = self.checkpoints[num]
+        stock = array('q')
+        if count:
+            self.checkpoint_file.seek(offset)
+            stock.frombytes(self.checkpoint_file.read(8 * count))
+        return stock
+
+    def _checkpoint_stock(self, num, item):
+        rows, offset, count = self.checkpoints[num]
+        if item >= count:
+            return 0
+        self.checkpoint_file.seek(offset + 8 * item)
+        return struct.unpack("<q", self.checkpoint_file.read(8))[0]
+
+    def _count(self, item, delta):
+        stock = self.stock
+        if item >= len(stock):
+            stock.extend([0] * (item + 1 - len(stock)))
+        stock[item] += delta
+
+    def mapped(self):
+        with self.lock:
+            size = self.rows * ROW.size
+            end = os.fstat(self.reader.fileno()).st_size
+            if self.view is None or len(self.view) < max(size, end - end % ROW.size):
+                if not end:
+                    return b""
+                self.view = mmap.mmap(self.reader.fileno(), 0, access=mmap.ACCESS_READ)
+            return self.view
+
+    def check(self, name):
+        """Raise ValueError if name cannot go in the .items file, one name per line."""
+        if not name or "\n" in name:
+            raise ValueError("bad item name: %r" % name)
+
+    def _intern(self, name):
+        item = self.ids.get(name)
+        if item is None:
+            self.check(name)
+            item = self.ids[name] = len(self.names)
+            self.names.append(name)
+            line = (name + "\n").encode()
+            self.names_file.write(line)
+            self.names_file.flush()
+            self.names_size += len(line)
+        return item
+
+    def _pack(self, name, delta, kind, when):
+        when = max(time.time() if when is None else when, self.last_time)
+        item = self._intern(name)
+        self.last_time = when
+        self._count(item, delta)
+        return ROW.pack(when, item << 2 | KINDS.index(kind), delta)
+
+    def _write_checkpoint(self):
+        self.checkpoint_file.seek(0, os.SEEK_END)
+        self.checkpoint_file.write(CHECKPOINT.pack(self.rows, len(self.stock)) + self.stock.tobytes())
+        self.checkpoint_file.flush()
+        self._load_checkpoints()
+
+    def append(self, name, delta, kind="adjust", when=None):
+        """Record one movement of delta units; when defaults to now."""
+        self.append_many([(name, delta, kind, when)])
+
+    def append_many(self, movements):
+        """Record (name, delta, kind, when) movements in order, in one locked write."""
+        with self.lock, self.file_lock:
+            self.refresh()
+            chunk = []
+            for name, delta, kind, when in movements:
+                chunk.append(self._pack(name, delta, kind, when))
+                self.rows += 1
+                if self.rows - self.checkpoints[-1][0] >= max(self.every, len(self.stock)):
+                    self.data.write(b"".join(chunk))
+                    self.data.flush()
+                    chunk = []
+                    self._write_checkpoint()
+            self.data.write(b"".join(chunk))
+            self.data.flush()
+
+    def seed(self, records):
+        """Log the quantity of every record as a receipt if the ledger is still empty.
+
+        Gives the items of a store the ledger was attached to later an
+        opening balance. Returns the number of receipts logged.
+        """
+        with self.lock, self.file_lock:
+            self.refresh()
+            if self.rows:
+                return 0
+            movements = []
+            for record in records:
+                try:
+                    self.check(record.name)
+                except ValueError:
+                    # a name the .items file cannot hold stays out of the ledger
+                    continue
+                if record.quantity:
+                    movements.append((record.name, record.quantity, "receipt", None))
+            self.append_many(movements)
+            return len(movements)
+
+    def receive(self, name, quantity, when=None):
+        self.append(name, quantity, "receipt", when)
+
+    def sell(self, name, quantity, when=None):
+        self.append(name, -quantity, "sale", when)
+
+    def _row_after(self, view, when, inclusive=False):
+        # first row stamped later than when, or at it when inclusive
+        lo, hi = 0, self.rows
+        while lo < hi:
+            mid = (lo + hi) // 2
+            stamp = ROW.unpack_from(view, mid * ROW.size)[0]
+            if stamp < when or stamp == when and not inclusive:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def stock_at(self, name, when=None):
+        """Units of name in stock at time when (default: now)."""
+        with self.lock:
+            self.refresh()
+            item = self.ids.get(name)
+            if item is None:
+                return 0
+            if when is None:
+                return self.stock[item] if item < len(self.stock) else 0
+            view = self.mapped()
+            end = self._row_after(view, when)
+            num = self._checkpoint_at(end)
+            stock = self._checkpoint_stock(num, item)
+            for _, tag, delta in ROW.iter_unpack(view[self.checkpoints[num][0] * ROW.size:end * ROW.size]):
+                if tag >> 2 == item:
+                    stock += delta
+            return stock
+
+    def stock_all_at(self, when=None):
+        """{name: units} for every item with stock at time when (default: now)."""
+        with self.lock:
+            self.refresh()
+            if when is None:
+                stock = self.stock
+            else:
+                view = self.mapped()
+                end = self._row_after(view, when)
+                num = self._checkpoint_at(end)
+                stock = self._checkpoint(num)
+                stock.extend([0] * (len(self.names) - len(stock)))
+                for _, tag, delta in ROW.iter_unpack(view[self.checkpoints[num][0] * ROW.size:end * ROW.size]):
+                    stock[tag >> 2] += delta
+            return {self.names[item]: units for item, units in enumerate(stock) if units}
+
+    def history(self, name, since=None, until=None):
+        """Return (time, kind, delta) for each movement of name in [since, until]."""
+        with self.lock:
+            self.refresh()
+            item = self.ids.get(name)
+            if item is None:
+                return []
+            view = self.mapped()
+            start = 0 if since is None else self._row_after(view, since, inclusive=True)
+            end = self.rows if until is None else self._row_after(view, until)
+            return [(when, KINDS[tag & 3], delta)
+                    for when, tag, delta in ROW.iter_unpack(view[start * ROW.size:end * ROW.size])
+                    if tag >> 2 == item]
+
+    def sync(self):
+        with self.lock:
+            for handle in (self.data, self.names_file, self.checkpoint_file):
+                os.fsync(handle.fileno())
+
+    def close(self):
+        self.sync()
+        self.view = None
+        for handle in (self.data, self.reader, self.names_file, self.checkpoint_file):
+            handle.close()
+        self.file_lock.close()
@@ -0,0 +1,193 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# bucket upper bounds in seconds: 10 us doubling up to about 10 s
+BOUNDS = [1e-5 * 2 ** num for num in range(21)]
+IO_PATH = "/proc/thread-self/io"
+
+
+# bytes each thread has read from IO_PATH itself, left out of its counts
+own_reads = threading.local()
+
+
+def thread_io():
+    """(bytes read, bytes written, page faults) of the calling thread so far.
+
+    Bytes count read() and write() calls, from /proc where Linux has it.
+    Reads through an mmap make no calls, so the faults they take stand in
+    for them. Whatever the platform lacks reads as 0.
+    """
+    read = written = faults = 0
+    try:
+        with open(IO_PATH, 'rb') as src:
+            text = src.read()
+    except OSError:
+        text = b""
+    for line in text.splitlines():
+        key, _, value = line.partition(b":")
+        if key == b"rchar":
+            read = int(value) - getattr(own_reads, "size", 0)
+        elif key == b"wchar":
+            written = int(value)
+    own_reads.size = getattr(own_reads, "size", 0) + len(text)
+    if resource is not None and hasattr(resource, "RUSAGE_THREAD"):
+        usage = resource.getrusage(resource.RUSAGE_THREAD)
+        faults = usage.ru_minflt + usage.ru_majflt
+    return read, written, faults
+
+
+class Histogram:
+    """Durations in fixed exponential buckets, plus count, sum and max.
+
+    Memory stays the same however many values are observed; quantiles
+    are interpolated within their bucket.
+    """
+
+    def __init__(self):
+        self.buckets = [0] * (len(BOUNDS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        low, high = 0, len(BOUNDS)
+        while low < high:
+            mid = (low + high) // 2
+            if seconds <= BOUNDS[mid]:
+                high = mid
+            else:
+                low = mid + 1
+        self.buckets[low] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, fraction):
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for num, count in enumerate(self.buckets):
+            if count and seen + count >= rank:
+                low = BOUNDS[num - 1] if num else 0.0
+                high = BOUNDS[num] if num < len(BOUNDS) else self.max
+                return min(self.max, low + (high - low) * (rank - seen) / count)
+            seen += count
+        return self.max
+
+
+class Metrics:
+    """Timings and I/O of named operations, grouped by stage.
+
+    Stages used by PMS.py: "storage" for the call on the worker thread,
+    "queue" for its wait to start, "ui" for the Tk callback that shows
+    the result and "total" from click to shown. The "lag" op of "ui"
+    is how late the event loop ran the heartbeat. Safe to update from
+    any thread.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        # (stage, op) -> [bytes read, bytes written, page faults]
+        self.io = {}
+
+    def observe(self, stage, op, seconds, io=None):
+        with self.lock:
+            key = (stage, op)
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+            if io is not None:
+                totals = self.io.setdefault(key, [0, 0, 0])
+                for num, value in enumerate(io):
+                    totals[num] += value
+
+    @contextmanager
+    def timed(self, stage, op, io=False):
+        """Time the block as op in stage; with io, also count its thread's I/O."""
+        before = thread_io() if io else None
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            used = None
+            if io:
+                used = [after - first for after, first in zip(thread_io(), before)]
+            self.observe(stage, op, seconds, used)
+
+    def call(self, op, func, *args):
+        """Run func(*args) as op in the storage stage, counting its I/O."""
+        with self.timed("storage", op, io=True):
+            return func(*args)
+
+    def summary(self):
+        """Return one dict per (stage, op): counts, quantiles in ms and I/O."""
+        with self.lock:
+            rows = []
+            for (stage, op), histogram in sorted(self.histograms.items()):
+                read, written, faults = self.io.get((stage, op), (0, 0, 0))
+                rows.append({
+                    "stage": stage,
+                    "op": op,
+                    "count": histogram.count,
+                    "mean_ms": round(histogram.sum / histogram.count * 1000, 3),
+                    "p50_ms": round(histogram.quantile(0.5) * 1000, 3),
+                    "p90_ms": round(histogram.quantile(0.9) * 1000, 3),
+                    "p99_ms": round(histogram.quantile(0.99) * 1000, 3),
+                    "max_ms": round(histogram.max * 1000, 3),
+                    "bytes_read": read,
+                    "bytes_written": written,
+                    "page_faults": faults,
+                })
+            return rows
+
+    def to_json(self):
+        return json.dumps({"time": time.time(), "operations": self.summary()}, indent=2)
+
+    def to_prometheus(self):
+        """The histograms and I/O counters in the Prometheus text format."""
+        lines = []
+        with self.lock:
+            stages = sorted({stage for stage, op in self.histograms})
+            for stage in stages:
+                name = "pms_%s_seconds" % stage
+                lines.append("# HELP %s Time spent in the %s stage of PMS operations." % (name, stage))
+                lines.append("# TYPE %s histogram" % name)
+                for (other, op), histogram in sorted(self.histograms.items()):
+                    if other != stage:
+                        continue
+                    seen = 0
+                    for bound, count in zip(BOUNDS + ["+Inf"], histogram.buckets):
+                        seen += count
+                        lines.append('%s_bucket{op="%s",le="%s"} %d' % (name, op, bound, seen))
+                    lines.append('%s_sum{op="%s"} %r' % (name, op, histogram.sum))
+                    lines.append('%s_count{op="%s"} %d' % (name, op, histogram.count))
+            for num, (field, text) in enumerate((("read_bytes", "Bytes read"), ("written_bytes", "Bytes written"),
+                                                 ("page_faults", "Page faults taken"))):
+                name = "pms_storage_%s_total" % field
+                lines.append("# HELP %s %s by PMS storage operations." % (name, text))
+                lines.append("# TYPE %s counter" % name)
+                for (stage, op), totals in sorted(self.io.items()):
+                    if stage != "storage":
+                        continue
+                    lines.append('%s{op="%s"} %d' % (name, op, totals[num]))
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path):
+        """Write path.json and path.prom, each replaced whole."""
+        for suffix, text in ((".json", self.to_json()), (".prom", self.to_prometheus())):
+            tmp_path = path + suffix + ".tmp"
+            with open(tmp_path, 'w') as dst:
+                dst.write(text)
+            os.replace(tmp_path, path + suffix)
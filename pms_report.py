@@ -0,0 +1,205 @@
+import mmap
+import os
+import sys
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+from pms_store import FORMATS, InventoryStore, file_signature, load_snapshot
+
+
+def _import_numpy():
+    # numbers.py next to this file would shadow the stdlib module numpy needs
+    here = os.path.dirname(os.path.abspath(__file__))
+    saved = sys.path[:]
+    sys.path[:] = [path for path in sys.path if os.path.abspath(path or ".") != here]
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+    finally:
+        sys.path[:] = saved
+    return numpy
+
+
+numpy = _import_numpy()
+
+CHUNK_ROWS = 1 << 16
+
+
+class SnapshotChanged(Exception):
+    """The data file was swapped by compaction while a report read it."""
+
+
+def store_snapshot(store):
+    """(path, format, format state, file identity, live offsets) of an open store."""
+    with store.lock:
+        store.refresh()
+        return (store.path, store.format.name, store.format.state(), store.identity,
+                array('Q', store.index.offsets))
+
+
+def file_snapshot(path):
+    """The same from the index saved next to path, or None if it is out of date.
+
+    Lets a report run without loading every index of a large store.
+    """
+    snap = load_snapshot(path + ".idx")
+    if snap is None:
+        return None
+    size, signature, (entries, offsets, state) = snap
+    with open(path, 'rb') as data:
+        stat = os.fstat(data.fileno())
+        head = data.read(len(FORMATS["binary"].header))
+    if stat.st_size != size or file_signature(path, size) != signature:
+        return None
+    name = "binary" if head == FORMATS["binary"].header else "text"
+    return path, name, state, (stat.st_dev, stat.st_ino), offsets
+
+
+def _text_columns(view, offsets):
+    base = offsets[0]
+    end = view.find(b"\n", offsets[-1])
+    if end - base > 64 * len(offsets):
+        # live lines far apart, slice them out one by one
+        lines = [view[offset:view.find(b"\n", offset)] for offset in offsets]
+    else:
+        # split the whole span and pick the live lines out of it
+        lines = view[base:end].split(b"\n")
+        if len(lines) != len(offsets):
+            lengths = numpy.fromiter(map(len, lines), dtype=numpy.int64, count=len(lines)) + 1
+            starts = numpy.concatenate(([0], numpy.cumsum(lengths[:-1])))
+            rows = numpy.searchsorted(starts, numpy.frombuffer(offsets, dtype=numpy.uint64).astype(numpy.int64) - base)
+            lines = [lines[row] for row in rows.tolist()]
+    fields = b" ".join(lines).split(b" ")
+    names, codes = numpy.unique(numpy.array(fields[3::5]), return_inverse=True)
+    return ([name.decode() for name in names], codes, numpy.array(list(map(float, fields[1::5]))),
+            numpy.array(list(map(int, fields[2::5])), dtype=numpy.int64), numpy.array(list(map(float, fields[4::5]))))
+
+
+def _columns(fmt, view, offsets):
+    """NumPy columns (categories, category codes, price, quantity, discount) of a chunk."""
+    if fmt.name == "text":
+        return _text_columns(view, offsets)
+    buf = numpy.frombuffer(view, dtype=numpy.uint8)
+    starts = numpy.frombuffer(offsets, dtype=numpy.uint64).astype(numpy.int64)
+    lengths = buf[starts + 1].astype(numpy.int64) | buf[starts + 2].astype(numpy.int64) << 8
+    bodies = starts + fmt.HEAD.size + lengths
+    raw = buf[bodies[:, None] + numpy.arange(fmt.BODY.size)]
+    body = numpy.ascontiguousarray(raw).view(numpy.dtype([("price", "<f8"), ("quantity", "<i8"),
+                                                           ("category", "<u2"), ("discount", "<f8")])).ravel()
+    return fmt.categories, body["category"], body["price"], body["quantity"], body["discount"]
+
+
+def _add_chunk(totals, fmt, view, offsets):
+    # totals: {category: [items, units, gross value, net value]}
+    if numpy is None:
+        for offset in offsets:
+            record = fmt.read_buffer(view, offset)
+            gross = record.price * record.quantity
+            entry = totals.setdefault(record.category, [0, 0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += record.quantity
+            entry[2] += gross
+            entry[3] += gross * (1 - record.discount / 100)
+        return
+    categories, codes, price, quantity, discount = _columns(fmt, view, offsets)
+    gross = price * quantity
+    sums = [numpy.bincount(codes, minlength=len(categories)),
+            numpy.bincount(codes, weights=quantity, minlength=len(categories)),
+            numpy.bincount(codes, weights=gross, minlength=len(categories)),
+            numpy.bincount(codes, weights=gross * (1 - discount / 100), minlength=len(categories))]
+    for code in numpy.flatnonzero(sums[0]):
+        entry = totals.setdefault(categories[code], [0, 0, 0.0, 0.0])
+        entry[0] += int(sums[0][code])
+        entry[1] += int(sums[1][code])
+        entry[2] += float(sums[2][code])
+        entry[3] += float(sums[3][code])
+
+
+def value_part(task):
+    """Category totals for one run of live offsets; runs in a worker process."""
+    path, name, state, identity, offsets, chunk_rows = task
+    fmt = FORMATS[name]()
+    fmt.restore(state)
+    totals = {}
+    if not len(offsets):
+        return totals
+    with open(path, 'rb') as data:
+        stat = os.fstat(data.fileno())
+        if (stat.st_dev, stat.st_ino) != identity:
+            raise SnapshotChanged(path)
+        view = mmap.mmap(data.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for start in range(0, len(offsets), chunk_rows):
+                _add_chunk(totals, fmt, view, offsets[start:start + chunk_rows])
+        finally:
+            view.close()
+    return totals
+
+
+def _merge(parts):
+    merged = {}
+    for part in parts:
+        for category, values in part.items():
+            entry = merged.setdefault(category, [0, 0, 0.0, 0.0])
+            for num, value in enumerate(values):
+                entry[num] += value
+    return merged
+
+
+def _snapshots(source):
+    if isinstance(source, str):
+        snap = file_snapshot(source)
+        if snap is not None:
+            return [snap]
+        store = InventoryStore(source)
+        try:
+            return [store_snapshot(store)]
+        finally:
+            store.close()
+    if hasattr(source, "shards"):
+        return [store_snapshot(shard) for shard in source.shards]
+    return [store_snapshot(source)]
+
+
+def valuation(source, workers=1, chunk_rows=CHUNK_ROWS):
+    """Stock valuation per category and overall.
+
+    source is an open store or the path of a database_proj log; a path is
+    read through its saved index when that is current, without loading
+    the others. Live records are read chunk_rows at a time into NumPy
+    columns (record by record when NumPy is missing), so memory stays
+    bounded by the chunk size plus the offsets. With workers > 1 the
+    records are split between that many processes.
+
+    Returns ({category: (items, units, gross value, net value)}, overall
+    tuple), where gross value is price * quantity and net value applies
+    the discount, a percentage: price * quantity * (1 - discount / 100).
+    """
+    if hasattr(source, "db"):
+        # SQLite aggregates in SQL
+        with source.lock:
+            rows = source.db.execute(
+                "SELECT category, COUNT(*), SUM(quantity), SUM(price * quantity),"
+                " SUM(price * quantity * (1 - discount / 100.0)) FROM items GROUP BY category").fetchall()
+        totals = {row[0]: list(row[1:]) for row in rows}
+    else:
+        for attempt in range(3):
+            tasks = []
+            for path, name, state, identity, offsets in _snapshots(source):
+                step = max(1, -(-len(offsets) // workers))
+                tasks += [(path, name, state, identity, offsets[start:start + step], chunk_rows)
+                          for start in range(0, len(offsets), step)]
+            try:
+                if workers > 1:
+                    with ProcessPoolExecutor(max_workers=workers) as pool:
+                        totals = _merge(pool.map(value_part, tasks))
+                else:
+                    totals = _merge(map(value_part, tasks))
+                break
+            except SnapshotChanged:
+                # compacted under us, take a fresh snapshot
+                if attempt == 2:
+                    raise
+    overall = tuple(sum(entry[num] for entry in totals.values()) for num in range(4))
+    return {category: tuple(entry) for category, entry in totals.items()}, overall
@@ -0,0 +1,303 @@
+import heapq
+import os
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from itertools import chain
+
+from pms_index import trigrams
+from pms_store import InventoryStore, detect_format, replace_file
+
+LAYOUT_FILE = "layout"
+
+
+def shard_of(name, shards):
+    """Bucket of an item name; stable across processes and Python runs."""
+    return zlib.crc32(name.encode()) % shards
+
+
+def live_records(path):
+    """Replay one shard's log straight from disk and return {name: record}.
+
+    Used by the report workers: reading every entry needs no index, so a
+    worker process only pays for the bytes of its own shard.
+    """
+    fmt = detect_format(path)
+    live = {}
+    with open(path, 'rb') as data:
+        for offset, end, name, record in fmt.entries(data, len(fmt.header)):
+            if record is not None:
+                live[name] = record
+            elif name is not None:
+                live.pop(name, None)
+    return live
+
+
+def shard_stock(path):
+    """{category: [stock value, items, discounted items]} for one shard."""
+    totals = {}
+    for record in live_records(path).values():
+        entry = totals.setdefault(record.category, [0.0, 0, 0])
+        entry[0] += record.price * record.quantity
+        entry[1] += 1
+        entry[2] += record.discount > 0
+    return totals
+
+
+class ShardedStore:
+    """The inventory split by item-name hash over several log files.
+
+    path is a directory holding shard00, shard01, ... each an ordinary
+    InventoryStore, and a layout file with the shard count. An item lives
+    in the shard its name hashes to, so add, update, delete and get touch
+    one shard only. Record numbers run through the shards in order.
+
+    map_shards() runs a function over every shard file in a process pool;
+    stock_report() uses it to value the whole catalogue in parallel. Each
+    shard is read as of the moment its worker gets to it, so a report
+    taken during writes is consistent per shard, not across shards.
+    """
+
+    def __init__(self, path, shards=8, **options):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        layout = os.path.join(path, LAYOUT_FILE)
+        if os.path.exists(layout):
+            with open(layout) as src:
+                shards = int(src.read())
+        else:
+            # a torn layout file would leave the shards unreadable
+            with open(layout + ".tmp", 'w') as dst:
+                dst.write("%d\n" % shards)
+                dst.flush()
+                os.fsync(dst.fileno())
+            replace_file(layout + ".tmp", layout)
+        self.shard_paths = [os.path.join(path, "shard%02d" % num) for num in range(shards)]
+        ledger = options.pop("ledger", None)
+        self.shards = [InventoryStore(shard_path, **options) for shard_path in self.shard_paths]
+        for shard in self.shards:
+            shard.ledger = ledger
+        if ledger is not None and not ledger.rows:
+            # seed from every shard at once, or the first would leave the ledger non-empty
+            with ExitStack() as stack:
+                for shard in self.shards:
+                    stack.enter_context(shard.writing())
+                ledger.seed(self.scan())
+
+    def shard(self, name):
+        return self.shards[shard_of(name, len(self.shards))]
+
+    def _start(self, shard):
+        # record number of the shard's first record
+        start = 0
+        for other in self.shards:
+            if other is shard:
+                return start
+            start += len(other)
+
+    def check(self, fields):
+        return self.shard(str(fields[0])).check(fields)
+
+    def add(self, fields):
+        shard = self.shard(str(fields[0]))
+        num = shard.add(fields)
+        return self._start(shard) + num
+
+    def add_many(self, rows):
+        buckets = [[] for _ in self.shards]
+        for fields in rows:
+            buckets[shard_of(str(fields[0]), len(self.shards))].append(fields)
+        return [name for shard, bucket in zip(self.shards, buckets) if bucket for name in shard.add_many(bucket)]
+
+    def update(self, fields):
+        shard = self.shard(str(fields[0]))
+        num = shard.update(fields)
+        return self._start(shard) + num
+
+    def move(self, name, delta, kind="adjust"):
+        shard = self.shard(name)
+        num = shard.move(name, delta, kind)
+        return self._start(shard) + num
+
+    def delete(self, name):
+        self.shard(name).delete(name)
+
+    def get(self, name):
+        return self.shard(name).get(name)
+
+    def search(self, name):
+        """Exact lookup on item name, returns (record number, record) or None."""
+        shard = self.shard(name)
+        found = shard.search(name)
+        if found is None:
+            return None
+        return self._start(shard) + found[0], found[1]
+
+    def position(self, name):
+        shard = self.shard(name)
+        return self._start(shard) + shard.position(name)
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    def __contains__(self, name):
+        return name in self.shard(name)
+
+    def record(self, num):
+        if num >= 0:
+            for shard in self.shards:
+                size = len(shard)
+                if num < size:
+                    return shard.record(num)
+                num -= size
+        raise IndexError(num)
+
+    def first(self):
+        return self.record(0)
+
+    def last(self):
+        return self.record(len(self) - 1)
+
+    def page(self, start, count):
+        """Return up to count records starting at record number start."""
+        stop = max(0, start + count)
+        start = max(0, start)
+        found = []
+        for shard in self.shards:
+            size = len(shard)
+            if start < size and stop > 0:
+                found += shard.page(start, min(stop, size) - start)
+            start = max(0, start - size)
+            stop -= size
+        return found
+
+    def scan(self):
+        """Yield every live record, shard by shard."""
+        return chain.from_iterable(shard.scan() for shard in self.shards)
+
+    def complete(self, prefix, limit=10):
+        names = chain.from_iterable(shard.complete(prefix, limit) for shard in self.shards)
+        return sorted(names, key=lambda name: (name.casefold(), name))[:limit]
+
+    def fuzzy(self, text, limit=10):
+        # every shard offers its own best; rank them against each other
+        wanted = trigrams(text)
+        scored = []
+        for shard in self.shards:
+            for name in shard.fuzzy(text, limit):
+                grams = trigrams(name)
+                scored.append((-len(wanted & grams) / len(wanted | grams), name))
+        return [name for _, name in sorted(scored)[:limit]]
+
+    def suggest(self, text, limit=10):
+        """Prefix completions, topped up with fuzzy matches for typos."""
+        found = self.complete(text, limit)
+        if len(found) < limit and len(text) >= 3:
+            found += [name for name in self.fuzzy(text, limit) if name not in found]
+        return found[:limit]
+
+    def in_category(self, category):
+        """Return the records filed under category, in name order."""
+        return list(heapq.merge(*[shard.in_category(category) for shard in self.shards],
+                                key=lambda record: record.name))
+
+    def category_totals(self):
+        """Return {category: (stock value, items, discounted items)}."""
+        return self._merge_totals(shard.category_totals() for shard in self.shards)
+
+    @staticmethod
+    def _merge_totals(parts):
+        merged = {}
+        for part in parts:
+            for category, (value, items, discounted) in part.items():
+                entry = merged.setdefault(category, [0.0, 0, 0])
+                entry[0] += value
+                entry[1] += items
+                entry[2] += discounted
+        return {category: tuple(entry) for category, entry in merged.items()}
+
+    def _merge_range(self, field, parts):
+        return list(heapq.merge(*parts, key=lambda record: (getattr(record, field), record.name)))
+
+    def between(self, field, low, high):
+        return self._merge_range(field, [shard.between(field, low, high) for shard in self.shards])
+
+    def below(self, field, value):
+        return self._merge_range(field, [shard.below(field, value) for shard in self.shards])
+
+    def above(self, field, value):
+        return self._merge_range(field, [shard.above(field, value) for shard in self.shards])
+
+    def set_reorder(self, level, item=None, category=None):
+        if item is not None:
+            self.shard(item).set_reorder(level, item=item)
+        else:
+            for shard in self.shards:
+                shard.set_reorder(level, category=category)
+
+    def low_stock(self):
+        return list(heapq.merge(*[shard.low_stock() for shard in self.shards],
+                                key=lambda found: found[0].name))
+
+    def import_rows(self, rows, batch_size=50000):
+        """Route rows to their shards, writing each shard's rows in batches."""
+        buckets = [[] for _ in self.shards]
+        count = 0
+        for fields in rows:
+            buckets[shard_of(str(fields[0]), len(self.shards))].append(fields)
+            count += 1
+            if count % batch_size == 0:
+                self._flush_buckets(buckets, batch_size)
+        self._flush_buckets(buckets, batch_size)
+        return count
+
+    def _flush_buckets(self, buckets, batch_size):
+        for shard, bucket in zip(self.shards, buckets):
+            if bucket:
+                shard.import_rows(bucket, batch_size)
+                bucket.clear()
+
+    import_csv = InventoryStore.import_csv
+    export_csv = InventoryStore.export_csv
+
+    def map_shards(self, func, workers=None):
+        """Return [func(shard path) for every shard], run in a process pool.
+
+        func must be a module-level function so it can be sent to the
+        workers. Every shard is synced first so the workers see all writes.
+        """
+        self.sync()
+        with ProcessPoolExecutor(max_workers=workers or min(len(self.shards), os.cpu_count() or 1)) as pool:
+            return list(pool.map(func, self.shard_paths))
+
+    def stock_report(self, workers=None):
+        """Category totals computed by scanning every shard in parallel."""
+        return self._merge_totals(self.map_shards(shard_stock, workers))
+
+    def sync(self):
+        for shard in self.shards:
+            shard.sync()
+
+    def save_index(self):
+        for shard in self.shards:
+            shard.save_index()
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+
+def split(src_path, dst_path, shards=8):
+    """Copy the live records of the database_proj log at src_path into shards."""
+    src = InventoryStore(src_path)
+    dst = ShardedStore(dst_path, shards)
+    try:
+        count = dst.import_rows(src.scan())
+        for name, level in sorted(src.item_levels.items()):
+            dst.set_reorder(level, item=name)
+        for category, level in sorted(src.category_levels.items()):
+            dst.set_reorder(level, category=category)
+    finally:
+        src.close()
+        dst.close()
+    return count
@@ -0,0 +1,386 @@
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from pms_index import NameIndex
+from pms_store import InventoryStore, Record, make_record
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    seq INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    price REAL NOT NULL,
+    quantity INTEGER NOT NULL,
+    category TEXT NOT NULL,
+    discount REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS items_name_nocase ON items (name COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS items_category ON items (category, name);
+CREATE INDEX IF NOT EXISTS items_price ON items (price, name);
+CREATE INDEX IF NOT EXISTS items_quantity ON items (quantity, name);
+CREATE INDEX IF NOT EXISTS items_discount ON items (discount, name);
+CREATE TABLE IF NOT EXISTS reorder (
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    level INTEGER NOT NULL,
+    PRIMARY KEY (kind, key)
+);
+"""
+
+COLUMNS = "name, price, quantity, category, discount"
+RANGE_FIELDS = ("price", "quantity", "discount")
+
+
+class SqliteStore:
+    """The pharmacy inventory in an indexed SQLite table.
+
+    Offers the same operations as pms_store.InventoryStore, so PMS.py and
+    pms_cli.py can use either. The database runs in WAL mode; durable
+    picks synchronous=FULL over NORMAL. Record numbers follow the order
+    items were first added; an update keeps an item's place. Finding one
+    means counting the rows before it, so add, update, move and search
+    give None in its place; position() counts when a caller needs it.
+
+    Every mutation commits on its own unless made inside batch(), which
+    wraps them in one transaction. With a pms_ledger.Ledger as ledger,
+    every change of quantity is also logged there, as in InventoryStore.
+    """
+
+    def __init__(self, path, durable=True, ledger=None):
+        self.path = path
+        self.ledger = ledger
+        self.lock = threading.RLock()
+        self.depth = 0
+        self.finder = None
+        self.closed = False
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=%s" % ("FULL" if durable else "NORMAL"))
+        self.db.executescript(SCHEMA)
+        if ledger is not None and not ledger.rows:
+            with self.lock:
+                ledger.seed(self.scan())
+
+    def _commit(self):
+        if not self.depth:
+            self.db.commit()
+
+    @contextmanager
+    def batch(self):
+        """Group the mutations made inside into a single transaction."""
+        with self.lock:
+            self.depth += 1
+            try:
+                yield
+            except BaseException:
+                self.depth -= 1
+                if not self.depth:
+                    self.db.rollback()
+                raise
+            self.depth -= 1
+            self._commit()
+
+    def _names_changed(self, name, record):
+        if self.finder is not None:
+            self.finder.apply(name, record)
+
+    def check(self, fields):
+        """Return the record fields make, or raise ValueError if SQLite cannot hold it."""
+        record = make_record(fields)
+        if not -2 ** 63 <= record.quantity < 2 ** 63:
+            raise ValueError("quantity out of range: %r" % record.quantity)
+        if self.ledger is not None:
+            self.ledger.check(record.name)
+        return record
+
+    def _insert(self, record):
+        try:
+            self.db.execute("INSERT INTO items (%s) VALUES (?, ?, ?, ?, ?)" % COLUMNS, record)
+        except sqlite3.IntegrityError:
+            raise KeyError(record.name) from None
+        self._names_changed(record.name, record)
+
+    def _quantity(self, name):
+        row = self.db.execute("SELECT quantity FROM items WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            raise KeyError(name)
+        return row[0]
+
+    def _moved(self, name, delta, kind):
+        # called with the store locked, so the ledger sees changes in commit order
+        if self.ledger is not None and delta:
+            self.ledger.append(name, delta, kind)
+
+    def add(self, fields):
+        record = self.check(fields)
+        with self.lock:
+            self._insert(record)
+            self._commit()
+            self._moved(record.name, record.quantity, "receipt")
+
+    def add_many(self, rows):
+        """Add new items from 5-field rows in one transaction; returns the names skipped."""
+        records = [self.check(fields) for fields in rows]
+        skipped, added = [], []
+        with self.batch():
+            for record in records:
+                try:
+                    self._insert(record)
+                except KeyError:
+                    skipped.append(record.name)
+                    continue
+                added.append(record)
+            if self.ledger is not None:
+                self.ledger.append_many([(record.name, record.quantity, "receipt", None)
+                                         for record in added if record.quantity])
+        return skipped
+
+    def update(self, fields):
+        record = self.check(fields)
+        with self.lock:
+            old = self._quantity(record.name)
+            self.db.execute(
+                "UPDATE items SET price = ?, quantity = ?, category = ?, discount = ? WHERE name = ?",
+                record[1:] + record[:1])
+            self._commit()
+            self._moved(record.name, record.quantity - old, "adjust")
+
+    def move(self, name, delta, kind="adjust"):
+        """Change the quantity of name by delta and log it as a receipt, sale or adjustment."""
+        with self.lock:
+            old = self._quantity(name)
+            if old + delta < 0:
+                raise ValueError("only %d of %s in stock" % (old, name))
+            self.db.execute("UPDATE items SET quantity = quantity + ? WHERE name = ?", (delta, name))
+            self._commit()
+            self._moved(name, delta, kind)
+
+    def delete(self, name):
+        with self.lock:
+            old = self._quantity(name)
+            self.db.execute("DELETE FROM items WHERE name = ?", (name,))
+            self._commit()
+            self._names_changed(name, None)
+            self._moved(name, -old, "adjust")
+
+    def sync(self):
+        with self.lock:
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.db.commit()
+            self.db.close()
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM items").fetchone()[0]
+
+    def __contains__(self, name):
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM items WHERE name = ?", (name,)).fetchone() is not None
+
+    def _records(self, sql, args=()):
+        with self.lock:
+            return [Record(*row) for row in self.db.execute(sql, args)]
+
+    def record(self, num):
+        if num < 0:
+            raise IndexError(num)
+        found = self._records("SELECT %s FROM items ORDER BY seq LIMIT 1 OFFSET ?" % COLUMNS, (num,))
+        if not found:
+            raise IndexError(num)
+        return found[0]
+
+    def first(self):
+        return self.record(0)
+
+    def last(self):
+        found = self._records("SELECT %s FROM items ORDER BY seq DESC LIMIT 1" % COLUMNS)
+        if not found:
+            raise IndexError(0)
+        return found[0]
+
+    def page(self, start, count):
+        """Return up to count records starting at record number start."""
+        first = max(0, start)
+        return self._records("SELECT %s FROM items ORDER BY seq LIMIT ? OFFSET ?" % COLUMNS,
+                             (max(0, start + count) - first, first))
+
+    def position(self, name):
+        with self.lock:
+            row = self.db.execute("SELECT seq FROM items WHERE name = ?", (name,)).fetchone()
+            if row is None:
+                raise KeyError(name)
+            return self.db.execute("SELECT COUNT(*) FROM items WHERE seq < ?", row).fetchone()[0]
+
+    def get(self, name):
+        found = self._records("SELECT %s FROM items WHERE name = ?" % COLUMNS, (name,))
+        if not found:
+            raise KeyError(name)
+        return found[0]
+
+    def search(self, name):
+        """Exact lookup on item name, returns (None, record) or None."""
+        try:
+            return None, self.get(name)
+        except KeyError:
+            return None
+
+    def complete(self, prefix, limit=10):
+        """Return up to limit item names starting with prefix, ignoring case."""
+        pattern = prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        with self.lock:
+            return [row[0] for row in self.db.execute(
+                "SELECT name FROM items WHERE name LIKE ? ESCAPE '\\' ORDER BY name COLLATE NOCASE LIMIT ?",
+                (pattern, limit))]
+
+    def fuzzy(self, text, limit=10):
+        """Return up to limit item names that look like text, best first."""
+        with self.lock:
+            if self.finder is None:
+                # SQLite has no trigram search, so the names are indexed in memory
+                self.finder = NameIndex()
+                for row in self.db.execute("SELECT name FROM items ORDER BY seq"):
+                    self.finder.apply(row[0], True)
+            return self.finder.fuzzy(text, limit)
+
+    suggest = InventoryStore.suggest
+
+    def in_category(self, category):
+        """Return the records filed under category, in name order."""
+        return self._records("SELECT %s FROM items WHERE category = ? ORDER BY name" % COLUMNS, (category,))
+
+    def category_totals(self):
+        """Return {category: (stock value, items, discounted items)}."""
+        with self.lock:
+            return {row[0]: tuple(row[1:]) for row in self.db.execute(
+                "SELECT category, SUM(price * quantity), COUNT(*), SUM(discount > 0) FROM items GROUP BY category")}
+
+    def _in_range(self, field, low, high, low_open=False, high_open=False):
+        if field not in RANGE_FIELDS:
+            raise KeyError(field)
+        where, args = [], []
+        if low is not None:
+            where.append("%s %s ?" % (field, ">" if low_open else ">="))
+            args.append(low)
+        if high is not None:
+            where.append("%s %s ?" % (field, "<" if high_open else "<="))
+            args.append(high)
+        return self._records("SELECT %s FROM items WHERE %s ORDER BY %s, name" % (
+            COLUMNS, " AND ".join(where) or "1", field), args)
+
+    def between(self, field, low, high):
+        """Return the records with low <= field <= high, in field order."""
+        return self._in_range(field, low, high)
+
+    def below(self, field, value):
+        """Return the records with field < value, in field order."""
+        return self._in_range(field, None, value, high_open=True)
+
+    def above(self, field, value):
+        """Return the records with field > value, in field order."""
+        return self._in_range(field, value, None, low_open=True)
+
+    def set_reorder(self, level, item=None, category=None):
+        """Set the reorder level of an item or of a whole category.
+
+        An item's own level wins over its category's. level None clears it.
+        """
+        if not (item if item is not None else category):
+            raise ValueError("a reorder level needs an item or category name")
+        kind, key = ("item", item) if item is not None else ("category", category)
+        with self.lock:
+            if level is None:
+                self.db.execute("DELETE FROM reorder WHERE kind = ? AND key = ?", (kind, key))
+            else:
+                self.db.execute("INSERT OR REPLACE INTO reorder VALUES (?, ?, ?)", (kind, key, int(level)))
+            self._commit()
+
+    def low_stock(self):
+        """Return (record, reorder level) for every item at or below its level, by name."""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT i.name, i.price, i.quantity, i.category, i.discount, COALESCE(r.level, c.level) AS level"
+                " FROM items i"
+                " LEFT JOIN reorder r ON r.kind = 'item' AND r.key = i.name"
+                " LEFT JOIN reorder c ON c.kind = 'category' AND c.key = i.category"
+                " WHERE i.quantity <= COALESCE(r.level, c.level) ORDER BY i.name").fetchall()
+        return [(Record(*row[:5]), row[5]) for row in rows]
+
+    def import_rows(self, rows, batch_size=50000):
+        """Insert or replace records from an iterable of 5-field rows.
+
+        Rows go through one prepared statement, batch_size per executemany,
+        all in a single transaction. Returns the number of rows loaded.
+        """
+        count = 0
+        sql = ("INSERT INTO items (%s) VALUES (?, ?, ?, ?, ?) ON CONFLICT (name) DO UPDATE SET"
+               " price = excluded.price, quantity = excluded.quantity,"
+               " category = excluded.category, discount = excluded.discount" % COLUMNS)
+        with self.batch():
+            batch, movements, latest = [], [], {}
+            for fields in rows:
+                record = self.check(fields)
+                if self.ledger is not None:
+                    movements.append(self._imported(record, latest))
+                batch.append(record)
+                count += 1
+                if len(batch) >= batch_size:
+                    self.db.executemany(sql, batch)
+                    self._log(movements)
+                    batch, movements, latest = [], [], {}
+            self.db.executemany(sql, batch)
+            self._log(movements)
+        self.finder = None
+        return count
+
+    def _imported(self, record, latest):
+        # as InventoryStore._imported, with the quantities written so far in the table
+        old = latest.get(record.name)
+        if old is None:
+            row = self.db.execute("SELECT quantity FROM items WHERE name = ?", (record.name,)).fetchone()
+            old = row[0] if row else None
+        latest[record.name] = record.quantity
+        if old is None:
+            return record.name, record.quantity, "receipt", None
+        return record.name, record.quantity - old, "adjust", None
+
+    _log = InventoryStore._log
+    import_csv = InventoryStore.import_csv
+
+    def scan(self):
+        """Yield every record in record-number order.
+
+        Reads through a connection of its own, so the scan sees one
+        consistent snapshot while writes carry on.
+        """
+        with self.lock:
+            self._commit()
+        reader = sqlite3.connect(self.path)
+        try:
+            for row in reader.execute("SELECT %s FROM items ORDER BY seq" % COLUMNS):
+                yield Record(*row)
+        finally:
+            reader.close()
+
+    export_csv = InventoryStore.export_csv
+
+
+def migrate(src_path, dst_path, batch_size=50000):
+    """Copy the live records of the database_proj log at src_path into SQLite."""
+    src = InventoryStore(src_path)
+    dst = SqliteStore(dst_path)
+    try:
+        count = dst.import_rows(src.scan(), batch_size)
+        for name, level in sorted(src.item_levels.items()):
+            dst.set_reorder(level, item=name)
+        for category, level in sorted(src.category_levels.items()):
+            dst.set_reorder(level, category=category)
+    finally:
+        src.close()
+        dst.close()
+    return count
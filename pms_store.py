@@ -0,0 +1,1325 @@
+import csv
+import mmap
+import os
+import pickle
+import struct
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+from pms_index import BloomIndex, CategoryIndex, LowStockIndex, NameIndex, RangeIndex
+
+DATA_FILE = "database_proj"
+# name of a crash_point() to die at, for pms_bench crash
+CRASH_AT = os.environ.get("PMS_CRASH_AT")
+TOMBSTONE = "-"
+FIELDS = ("name", "price", "quantity", "category", "discount")
+
+Record = namedtuple("Record", FIELDS)
+
+
+def make_record(fields):
+    """Check five raw fields and convert price, quantity and discount."""
+    if len(fields) != len(FIELDS):
+        raise ValueError("expected %d fields, got %r" % (len(FIELDS), fields))
+    name, price, quantity, category, discount = fields
+    name = str(name)
+    if not name or name != name.strip():
+        raise ValueError("bad item name: %r" % name)
+    return Record(name, float(price), int(quantity), str(category), float(discount))
+
+
+class TextFormat:
+    """One space-separated line per record, '- name' for a tombstone.
+
+    Logs written by the old PMS.py may hold lines that are not records:
+    empty fields, names with spaces, two lines run together. entries()
+    passes over those and keeps them in rejected as (offset, line).
+    """
+
+    name = "text"
+    header = b""
+
+    def __init__(self):
+        self.rejected = []
+
+    def check(self, record):
+        """Raise ValueError if record would not read back as written.
+
+        Accepts whatever decode() does: an empty category or one named
+        '-', both left in logs by the old PMS.py, survive the round trip.
+        """
+        if record.name == TOMBSTONE:
+            raise ValueError("text records cannot be named %r" % TOMBSTONE)
+        for value in (record.name, record.category):
+            if " " in value or "\n" in value:
+                raise ValueError("text records need values without spaces: %r" % value)
+
+    def encode(self, record):
+        """Return the (bytes, name, record) entries that store record."""
+        self.check(record)
+        line = '{0} {1} {2} {3} {4}\n'.format(*record).encode()
+        return [(line, record.name, record)]
+
+    def encode_tombstone(self, name):
+        return [('{0} {1}\n'.format(TOMBSTONE, name).encode(), name, None)]
+
+    def decode(self, line):
+        values = line.decode().rstrip("\n").split(" ")
+        if values[0] == TOMBSTONE:
+            return values[1], None
+        return values[0], make_record(values)
+
+    def read(self, data, offset):
+        data.seek(offset)
+        return self.decode(data.readline())[1]
+
+    def read_buffer(self, buf, offset):
+        end = buf.find(b"\n", offset)
+        return self.decode(buf[offset:end + 1])[1]
+
+    def entries(self, data, pos):
+        """Yield (offset, end, name, record) for every whole line from pos."""
+        data.seek(pos)
+        for line in data:
+            if not line.endswith(b"\n"):
+                return
+            try:
+                name, record = self.decode(line)
+            except (ValueError, IndexError):
+                self.rejected.append((pos, line))
+                name = record = None
+            yield pos, pos + len(line), name, record
+            pos += len(line)
+
+    def state(self):
+        return None
+
+    def restore(self, state):
+        pass
+
+
+class BinaryFormat:
+    """Struct-packed records behind a magic header.
+
+    Every entry starts with a kind byte and a length-prefixed name. Records
+    follow it with price, quantity, category id and discount. Category
+    names are interned: the first record using a category is preceded by a
+    CATEGORY entry, and the category's id is its position among those.
+    """
+
+    name = "binary"
+    header = b"PMSBIN1\n"
+    RECORD, TOMBSTONE, CATEGORY = range(3)
+    HEAD = struct.Struct("<BH")
+    BODY = struct.Struct("<dqHd")
+    CHUNK = 1 << 20
+
+    def __init__(self):
+        self.categories = []
+        self.category_ids = {}
+
+    def _intern(self, category):
+        if category not in self.category_ids:
+            self.category_ids[category] = len(self.categories)
+            self.categories.append(category)
+        return self.category_ids[category]
+
+    def _entry(self, kind, name):
+        raw = name.encode()
+        return self.HEAD.pack(kind, len(raw)) + raw
+
+    def check(self, record):
+        """Raise ValueError if record does not fit the packed layout."""
+        for value in (record.name, record.category):
+            if len(value.encode()) > 0xFFFF:
+                raise ValueError("value too long to store: %r" % value[:40])
+        if not -2 ** 63 <= record.quantity < 2 ** 63:
+            raise ValueError("quantity out of range: %r" % record.quantity)
+
+    def encode(self, record):
+        self.check(record)
+        entries = []
+        if record.category not in self.category_ids:
+            entries.append((self._entry(self.CATEGORY, record.category), None, None))
+        body = self.BODY.pack(record.price, record.quantity, self._intern(record.category), record.discount)
+        entries.append((self._entry(self.RECORD, record.name) + body, record.name, record))
+        return entries
+
+    def encode_tombstone(self, name):
+        return [(self._entry(self.TOMBSTONE, name), name, None)]
+
+    def decode(self, buf, pos):
+        """Return (end, name, record) for the entry at pos, or None if cut short."""
+        if len(buf) - pos < self.HEAD.size:
+            return None
+        kind, length = self.HEAD.unpack_from(buf, pos)
+        start = pos + self.HEAD.size
+        end = start + length
+        if kind == self.RECORD:
+            end += self.BODY.size
+        if len(buf) < end:
+            return None
+        name = bytes(buf[start:start + length]).decode()
+        if kind == self.CATEGORY:
+            self._intern(name)
+            return end, None, None
+        if kind == self.TOMBSTONE:
+            return end, name, None
+        price, quantity, category, discount = self.BODY.unpack_from(buf, start + length)
+        return end, name, Record(name, price, quantity, self.categories[category], discount)
+
+    def read(self, data, offset):
+        data.seek(offset)
+        buf = data.read(128)
+        entry = self.decode(buf, 0)
+        if entry is None:
+            buf += data.read(self.HEAD.unpack_from(buf)[1] + self.BODY.size)
+            entry = self.decode(buf, 0)
+        return entry[2]
+
+    def read_buffer(self, buf, offset):
+        return self.decode(buf, offset)[2]
+
+    def entries(self, data, pos):
+        data.seek(pos)
+        buf = b""
+        i = 0
+        while True:
+            entry = self.decode(buf, i)
+            if entry is None:
+                chunk = data.read(self.CHUNK)
+                if not chunk:
+                    return
+                buf = buf[i:] + chunk
+                i = 0
+                continue
+            end, name, record = entry
+            yield pos, pos + end - i, name, record
+            pos += end - i
+            i = end
+
+    def state(self):
+        return self.categories
+
+    def restore(self, state):
+        for category in state:
+            self._intern(category)
+
+
+FORMATS = {TextFormat.name: TextFormat, BinaryFormat.name: BinaryFormat}
+
+
+def detect_format(path, default="text"):
+    with open(path, 'rb') as data:
+        head = data.read(len(BinaryFormat.header))
+    if head == BinaryFormat.header:
+        return BinaryFormat()
+    if head:
+        return TextFormat()
+    return FORMATS[default]()
+
+
+def file_signature(path, size, length=64):
+    """Bytes just before size, used to check a snapshot still fits the file."""
+    with open(path, 'rb') as data:
+        data.seek(max(0, size - length))
+        return data.read(min(size, length))
+
+
+def load_snapshot(path):
+    """Return (data size, signature, payload) saved by save_snapshot, or None."""
+    try:
+        with open(path, 'rb') as snap:
+            return pickle.load(snap)
+    except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+        return None
+
+
+def save_snapshot(path, size, signature, payload, sync=True):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as snap:
+        pickle.dump((size, signature, payload), snap, pickle.HIGHEST_PROTOCOL)
+        if sync:
+            snap.flush()
+            os.fsync(snap.fileno())
+    crash_point("snapshot-written")
+    replace_file(tmp_path, path, sync)
+
+
+def crash_point(name):
+    """Kill the process here if PMS_CRASH_AT names this point."""
+    if CRASH_AT == name:
+        os._exit(70)
+
+
+def sync_dir(path):
+    """fsync the directory holding path, so a rename in it survives a crash."""
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        # Windows cannot open a directory, and keeps renames durable itself
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def replace_file(tmp_path, path, sync=True):
+    """Swap the written and fsynced tmp_path in for path.
+
+    os.replace is atomic, so after a crash path holds either all its old
+    or all its new bytes; the directory fsync makes the swap itself last.
+    """
+    os.replace(tmp_path, path)
+    if sync:
+        sync_dir(path)
+
+
+def might_contain(path, name):
+    """False only if the store at path certainly has no item called name.
+
+    Answers from the Bloom filter saved next to the data file plus a byte
+    search of whatever was appended since, without loading any index. Any
+    doubt, such as a missing or outdated filter, gives True.
+    """
+    snap = load_snapshot(path + "." + BloomIndex.suffix)
+    if snap is None:
+        return True
+    size, signature, state = snap
+    try:
+        if file_signature(path, size) != signature:
+            return True
+        bloom = BloomIndex()
+        bloom.restore(state)
+    except (OSError, TypeError, ValueError):
+        return True
+    if name in bloom:
+        return True
+    # entries appended after the filter was saved
+    needle = name.encode()
+    with open(path, 'rb') as data:
+        data.seek(size)
+        tail = b""
+        for chunk in iter(lambda: data.read(1 << 20), b""):
+            tail = tail[-len(needle):] + chunk
+            if needle in tail:
+                return True
+    return False
+
+
+class FileLock:
+    """Exclusive lock shared by every process that opens the same store.
+
+    Re-entrant within one process; callers serialise threads themselves.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.handle = None
+        self.depth = 0
+
+    def acquire(self, blocking=True):
+        """Take the lock; without blocking, return False at once if it is held."""
+        if not self.depth:
+            if self.handle is None:
+                self.handle = open(self.path, 'a+b')
+            if fcntl is not None:
+                try:
+                    fcntl.flock(self.handle.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+                except BlockingIOError:
+                    return False
+            else:
+                self.handle.seek(0)
+                while True:
+                    try:
+                        msvcrt.locking(self.handle.fileno(), msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+                        break
+                    except OSError:
+                        if not blocking:
+                            return False
+        self.depth += 1
+        return True
+
+    def release(self):
+        self.depth -= 1
+        if not self.depth:
+            if fcntl is not None:
+                fcntl.flock(self.handle.fileno(), fcntl.LOCK_UN)
+            else:
+                self.handle.seek(0)
+                msvcrt.locking(self.handle.fileno(), msvcrt.LK_UNLCK, 1)
+
+    def close(self):
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class GroupCommit:
+    """Makes appends durable a whole batch at a time.
+
+    Every append takes a ticket. A writer waiting on its ticket either
+    becomes the leader and runs sync() for everything written so far, or
+    waits for the leader's fsync in flight to cover it, so concurrent
+    writers share fsyncs. When other writers are pending the leader first
+    lingers up to max_delay for max_batch tickets to gather. Without
+    waiters, a background thread syncs each batch within max_delay.
+    """
+
+    def __init__(self, sync, max_delay=0.01, max_batch=128, background=False):
+        self.sync = sync
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self.background = background
+        self.cond = threading.Condition()
+        self.written = 0
+        self.synced = 0
+        self.batches = 0
+        self.syncing = False
+        self.thread = None
+        self.closed = False
+
+    def ticket(self):
+        with self.cond:
+            self.written += 1
+            if self.background and self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+            self.cond.notify_all()
+            return self.written
+
+    def wait(self, ticket=None):
+        """Block until ticket (default: every append so far) is durable."""
+        with self.cond:
+            if ticket is None:
+                ticket = self.written
+            while self.synced < ticket:
+                if self.syncing:
+                    self.cond.wait()
+                else:
+                    self._sync_batch(self.written - self.synced > 1)
+
+    def _sync_batch(self, linger):
+        # called with cond held and no sync in flight
+        self.syncing = True
+        try:
+            deadline = time.monotonic() + self.max_delay
+            while linger and self.written - self.synced < self.max_batch and not self.closed:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    break
+                self.cond.wait(left)
+            target = self.written
+            self.cond.release()
+            try:
+                self.sync()
+            finally:
+                self.cond.acquire()
+            self.synced = max(self.synced, target)
+            self.batches += 1
+        finally:
+            self.syncing = False
+            self.cond.notify_all()
+
+    def _run(self):
+        with self.cond:
+            while True:
+                while (self.synced == self.written or self.syncing) and not self.closed:
+                    self.cond.wait()
+                if self.closed:
+                    return
+                self._sync_batch(True)
+
+    def close(self):
+        self.wait()
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+
+
+class LogIndex:
+    """Live records of the append-only log.
+
+    offsets holds the byte offset of every live record in file order and
+    names maps the exact item name to the offset of its latest version.
+    entries counts every record and tombstone in the log, so
+    1 - len(offsets) / entries is the share of the file that compaction
+    would reclaim.
+    """
+
+    def __init__(self, size=0):
+        self.size = size
+        self.entries = 0
+        self.offsets = array('Q')
+        self.names = {}
+
+    def apply(self, offset, end, name, record):
+        """Index one log entry and return the offset it replaced, if any."""
+        self.size = end
+        if name is None:
+            return None
+        old = self.names.pop(name, None)
+        if old is not None:
+            del self.offsets[bisect_left(self.offsets, old)]
+        if record is not None:
+            self.names[name] = offset
+            self.offsets.append(offset)
+        self.entries += 1
+        return old
+
+    def dead_ratio(self):
+        if not self.entries:
+            return 0.0
+        return 1.0 - len(self.offsets) / self.entries
+
+
+class RecordCache:
+    """Bounded least-recently-used map of item name to decoded record.
+
+    A capacity of 0 turns the cache off. hits and misses count get() calls
+    since the last clear().
+    """
+
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self.records = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, name):
+        record = self.records.get(name)
+        if record is None:
+            self.misses += 1
+            return None
+        self.records.move_to_end(name)
+        self.hits += 1
+        return record
+
+    def put(self, name, record):
+        if not self.capacity:
+            return
+        self.records[name] = record
+        self.records.move_to_end(name)
+        if len(self.records) > self.capacity:
+            self.records.popitem(last=False)
+
+    def replace(self, name, record):
+        """Keep a cached name current with a new version, or drop it when deleted."""
+        if name in self.records:
+            if record is None:
+                del self.records[name]
+            else:
+                self.records[name] = record
+
+    def clear(self):
+        self.records.clear()
+        self.hits = self.misses = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"capacity": self.capacity, "size": len(self.records), "hits": self.hits,
+                "misses": self.misses, "hit_ratio": self.hits / lookups if lookups else 0.0}
+
+
+class InventoryStore:
+    """Pharmacy inventory kept in an append-only log.
+
+    Adds and updates append the new version of a record and deletes append
+    a tombstone, so every edit is one small write. Once dead versions make
+    up more than compact_ratio of the log, a background thread rewrites
+    the live records into a fresh file. New files use fmt ("text" or
+    "binary"); existing ones keep the format they were written in.
+
+    Secondary indexes keyed by item name (see pms_index) are told about
+    every change through apply(name, record) and are snapshotted next to
+    the data file with the primary index.
+
+    Every add, update and delete is flushed to the OS at once, so other
+    processes see it immediately. Durability is group committed: a batch
+    of appends shares one fsync, issued after at most sync_delay seconds
+    or sync_batch appends. When durable is set, a mutation returns only
+    once its batch is on disk. sync_batch=1 fsyncs every append inline.
+    Recovery after a crash is the normal open: entries after the last
+    index snapshot are replayed and a torn final entry is truncated.
+    Files are only ever rewritten into a temporary file that is fsynced
+    and then renamed over the original, so open also clears away the
+    temporary files of rewrites that never finished; see _recover().
+
+    Several processes may share one store. Writers hold an exclusive lock
+    on database_proj.lock and first replay whatever the others appended.
+    Readers take no lock: refresh() picks up whole entries appended since
+    the last look, and reloads the indexes once the file has been swapped
+    by another process's compaction. A reader therefore always sees a
+    consistent prefix of the log.
+
+    get() and search() go through an LRU cache of cache_size decoded
+    records, kept current by every applied entry, including those replayed
+    from other processes.
+
+    With a pms_ledger.Ledger as ledger, every change of quantity is also
+    recorded there as a movement: adds as receipts, move() as receipts,
+    sales or adjustments, and updates and deletes as adjustments. Imports
+    log receipts for new items and adjustments for replaced ones. A ledger
+    still empty when attached first gets every live item as a receipt.
+    The caller owns and closes the ledger.
+    """
+
+    def __init__(self, path=DATA_FILE, compact_ratio=0.5, compact_min=1000, fmt="text",
+                 sync_delay=0.01, sync_batch=128, durable=True, cache_size=1024, ledger=None):
+        self.path = path
+        self.index_path = path + ".idx"
+        self.names_path = path + ".hidx"
+        self.compact_ratio = compact_ratio
+        self.compact_min = compact_min
+        self.lock = threading.RLock()
+        self.file_lock = FileLock(path + ".lock")
+        # held by whichever process is compacting the log
+        self.compact_lock = FileLock(path + ".compacting")
+        self.compactor = None
+        self.handle = None
+        self.writer = None
+        self.view = None
+        self.durable = durable
+        self.cache = RecordCache(cache_size)
+        self.ledger = ledger
+        self.committer = None
+        if sync_batch > 1:
+            self.committer = GroupCommit(self._fsync, sync_delay, sync_batch, background=not durable)
+        self.levels_path = path + ".reorder"
+        self.recovered = []
+        self.item_levels, self.category_levels = self._load_levels()
+        # no lock file yet: a log written by the old PMS.py, not by this class
+        legacy = not os.path.exists(path + ".lock")
+        with self.file_lock:
+            self.recovered += self._recover()
+            open(self.path, 'a').close()
+            self.format = detect_format(self.path, fmt)
+            if not os.path.getsize(self.path) and self.format.header:
+                with open(self.path, 'ab') as data:
+                    data.write(self.format.header)
+            self._load_indexes(legacy)
+        if ledger is not None and not ledger.rows:
+            with self.writing():
+                ledger.seed(self.scan())
+
+    def _recover(self):
+        """Clear up rewrites a crashed process left half done; returns what was done.
+
+        Callers hold file_lock. Snapshot and reorder-level rewrites happen
+        under it too, so any .tmp file found is one whose writer died
+        before the rename. A compaction writes database_proj.compact<pid>
+        holding the .compacting lock, so while that lock is free any such
+        file is left over. The original is whole in either case, since the
+        rename is the last step.
+
+        The PMS.py of old rewrote the log into database_proj1, removed the
+        log and then renamed; a crash between the two left only the copy,
+        which is put back.
+        """
+        done = []
+        legacy = self.path + "1"
+        if not os.path.exists(self.path) and os.path.exists(legacy):
+            replace_file(legacy, self.path)
+            done.append("restored %s from %s" % (self.path, legacy))
+        # the indexes do not exist yet, so name their snapshots from the classes
+        snapshots = [self.index_path, self.names_path] + [
+            self.path + "." + kind.suffix for kind in (CategoryIndex, NameIndex, RangeIndex, LowStockIndex, BloomIndex)]
+        leftovers = [path + ".tmp" for path in snapshots + [self.levels_path]]
+        if self.compact_lock.acquire(blocking=False):
+            try:
+                folder = os.path.dirname(os.path.abspath(self.path))
+                prefix = os.path.basename(self.path) + ".compact"
+                leftovers += [os.path.join(folder, name) for name in os.listdir(folder)
+                              if name.startswith(prefix) and name[len(prefix):].isdigit()]
+                for path in leftovers:
+                    if os.path.exists(path):
+                        os.remove(path)
+                        done.append("removed unfinished rewrite %s" % path)
+            finally:
+                self.compact_lock.release()
+        return done
+
+    def _reset_indexes(self):
+        self.format = type(self.format)()
+        self.index = LogIndex(len(self.format.header))
+        self.cache.records.clear()
+        self.categories = CategoryIndex()
+        self.finder = NameIndex()
+        self.ranges = RangeIndex()
+        self.lowstock = LowStockIndex(self.item_levels, self.category_levels)
+        self.bloom = BloomIndex()
+
+    def secondary(self):
+        return [self.categories, self.finder, self.ranges, self.lowstock, self.bloom]
+
+    def _snapshot_paths(self):
+        return [self.index_path, self.names_path] + [
+            self.path + "." + index.suffix for index in self.secondary()]
+
+    def _open(self):
+        # the handle pins the inode, so identity cannot be reused by another file
+        if self.handle is not None:
+            self.handle.close()
+            self.writer.close()
+        self.view = None
+        self.handle = open(self.path, 'rb')
+        self.writer = open(self.path, 'ab')
+        stat = os.fstat(self.handle.fileno())
+        self.identity = (stat.st_dev, stat.st_ino)
+        return stat.st_size
+
+    def _load_indexes(self, legacy=False):
+        # callers hold file_lock
+        size = self._open()
+        self.format = detect_format(self.path, self.format.name)
+        self._reset_indexes()
+        snaps = [load_snapshot(path) for path in self._snapshot_paths()]
+        head = snaps[0]
+        if (all(snaps) and all(snap[:2] == head[:2] for snap in snaps) and head[0] <= size
+                and file_signature(self.path, head[0]) == head[1]):
+            try:
+                self.index.entries, self.index.offsets, state = head[2]
+                self.format.restore(state)
+                self.index.names = snaps[1][2]
+                for index, snap in zip(self.secondary(), snaps[2:]):
+                    index.restore(snap[2])
+                self.index.size = head[0]
+            except (TypeError, ValueError):
+                # snapshot from an older layout, index from scratch
+                self._reset_indexes()
+        self._replay()
+        if self.index.size < size:
+            self._repair_tail(size, legacy)
+
+    def _repair_tail(self, size, legacy=False):
+        """Deal with the bytes past the last whole entry; callers hold file_lock.
+
+        The old PMS.py wrote updated lines without their newline, so a
+        legacy text log may end in a whole record that only lacks it; that
+        gets its newline back. Anything else is an append torn by a crash,
+        moved to database_proj.torn rather than thrown away.
+        """
+        with open(self.path, 'rb') as data:
+            data.seek(self.index.size)
+            tail = data.read(size - self.index.size)
+        if legacy and self.format.name == "text":
+            try:
+                self.format.decode(tail)
+            except (ValueError, IndexError):
+                pass
+            else:
+                with open(self.path, 'ab') as data:
+                    data.write(b"\n")
+                self.recovered.append("added the missing newline at the end of %s" % self.path)
+                self._replay()
+                return
+        with open(self.path + ".torn", 'ab') as side:
+            side.write(tail + b"\n")
+            side.flush()
+            os.fsync(side.fileno())
+        os.truncate(self.path, self.index.size)
+        self.recovered.append("moved %d unreadable bytes from the end of %s to %s.torn" % (
+            len(tail), self.path, self.path))
+
+    def refresh(self):
+        """Catch up with entries appended by other processes."""
+        with self.lock:
+            stat = os.stat(self.path)
+            if (stat.st_dev, stat.st_ino) == self.identity:
+                if stat.st_size > self.index.size:
+                    self._replay()
+                return
+            # another process compacted the log
+            with self.file_lock:
+                self._load_indexes()
+
+    @contextmanager
+    def writing(self):
+        """Hold both locks, with the indexes caught up to the end of the log."""
+        with self.lock, self.file_lock:
+            self.refresh()
+            size = os.fstat(self.handle.fileno()).st_size
+            if size > self.index.size:
+                # left torn by a writer that crashed mid-append
+                self._repair_tail(size)
+            yield
+
+    def _replay(self):
+        """Apply every whole entry from the indexed size to the end of the log."""
+        for entry in self.format.entries(self.handle, self.index.size):
+            self._apply(*entry)
+        rejected = getattr(self.format, "rejected", None)
+        if rejected:
+            # copy them aside: compaction leaves out whatever is not a record
+            with open(self.path + ".bad", 'ab') as side:
+                for offset, line in rejected:
+                    side.write(b"%d " % offset + line)
+            self.recovered.append("set aside %d unreadable lines of %s in %s.bad" % (
+                len(rejected), self.path, self.path))
+            del rejected[:]
+
+    def _apply(self, offset, end, name, record):
+        old = self.index.apply(offset, end, name, record)
+        if name is not None:
+            self.cache.replace(name, record)
+            for index in self.secondary():
+                index.apply(name, record)
+            if self.bloom.overfull():
+                self.bloom.rebuild(self.index.names)
+        return old
+
+    def save_index(self):
+        with self.writing():
+            index = self.index
+            signature = file_signature(self.path, index.size)
+            states = [(index.entries, index.offsets, self.format.state()), index.names]
+            states += [index.state() for index in self.secondary()]
+            for path, state in zip(self._snapshot_paths(), states):
+                save_snapshot(path, index.size, signature, state, self.durable)
+
+    def _fsync(self):
+        with self.lock:
+            fd = os.dup(self.writer.fileno())
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _commit(self):
+        """Called after an append with the locks held; returns a ticket or None."""
+        if self.committer is None:
+            os.fsync(self.writer.fileno())
+            return None
+        return self.committer.ticket()
+
+    def _durable(self, ticket):
+        if ticket is not None and self.durable:
+            self.committer.wait(ticket)
+
+    def sync(self):
+        """Block until every append made so far is on disk."""
+        if self.committer is not None:
+            self.committer.wait()
+
+    def close(self):
+        if self.compactor is not None:
+            self.compactor.join()
+        if self.committer is not None:
+            self.committer.close()
+        self.save_index()
+        with self.lock:
+            if self.view is not None:
+                self.view.close()
+                self.view = None
+            if self.handle is not None:
+                self.handle.close()
+                self.writer.close()
+                self.handle = self.writer = None
+        self.file_lock.close()
+        self.compact_lock.close()
+
+    def __len__(self):
+        self.refresh()
+        return len(self.index.offsets)
+
+    def __contains__(self, name):
+        self.refresh()
+        return name in self.index.names
+
+    def mapped(self):
+        """Read-only mmap of the data file covering every indexed entry.
+
+        The mapping is shared through the page cache with every other
+        process reading the same file. It is remapped once appends run past
+        its end, and dropped when compaction swaps the file.
+        """
+        with self.lock:
+            if self.view is None or len(self.view) < self.index.size:
+                if not self.index.size:
+                    return b""
+                self.view = mmap.mmap(self.handle.fileno(), 0, access=mmap.ACCESS_READ)
+            return self.view
+
+    def _read_at(self, offset):
+        return self.format.read_buffer(self.mapped(), offset)
+
+    def record(self, num):
+        with self.lock:
+            self.refresh()
+            offsets = self.index.offsets
+            if num < 0 or num >= len(offsets):
+                raise IndexError(num)
+            return self._read_at(offsets[num])
+
+    def first(self):
+        return self.record(0)
+
+    def last(self):
+        return self.record(len(self) - 1)
+
+    def page(self, start, count):
+        """Return up to count records starting at record number start."""
+        with self.lock:
+            self.refresh()
+            view = self.mapped()
+            return [self.format.read_buffer(view, offset)
+                    for offset in self.index.offsets[max(0, start):max(0, start + count)]]
+
+    def position(self, name):
+        with self.lock:
+            return bisect_left(self.index.offsets, self.index.names[name])
+
+    def get(self, name):
+        with self.lock:
+            self.refresh()
+            record = self.cache.get(name)
+            if record is None:
+                record = self._read_at(self.index.names[name])
+                self.cache.put(name, record)
+            return record
+
+    def cache_stats(self):
+        """Return the record cache's capacity, size, hits, misses and hit ratio."""
+        with self.lock:
+            return self.cache.stats()
+
+    def search(self, name):
+        """Exact lookup on item name, returns (record number, record) or None."""
+        with self.lock:
+            self.refresh()
+            if name not in self.index.names:
+                return None
+            return self.position(name), self.get(name)
+
+    def complete(self, prefix, limit=10):
+        """Return up to limit item names starting with prefix, ignoring case."""
+        with self.lock:
+            self.refresh()
+            return self.finder.prefix(prefix, limit)
+
+    def fuzzy(self, text, limit=10):
+        """Return up to limit item names that look like text, best first."""
+        with self.lock:
+            self.refresh()
+            return self.finder.fuzzy(text, limit)
+
+    def suggest(self, text, limit=10):
+        """Prefix completions, topped up with fuzzy matches for typos."""
+        with self.lock:
+            found = self.complete(text, limit)
+            if len(found) < limit and len(text) >= 3:
+                found += [name for name in self.fuzzy(text, limit) if name not in found]
+            return found[:limit]
+
+    def _write(self, data, entries):
+        data.write(b"".join(entry[0] for entry in entries))
+        for raw, name, record in entries:
+            self._apply(self.index.size, self.index.size + len(raw), name, record)
+
+    def _append(self, entries):
+        self._write(self.writer, entries)
+        self.writer.flush()
+        return self._commit()
+
+    def check(self, fields):
+        """Return the record fields make, or raise ValueError if this store cannot hold it."""
+        record = make_record(fields)
+        self.format.check(record)
+        if self.ledger is not None:
+            self.ledger.check(record.name)
+        return record
+
+    def add(self, fields):
+        record = self.check(fields)
+        with self.writing():
+            if record.name in self.index.names:
+                raise KeyError(record.name)
+            ticket = self._append(self.format.encode(record))
+            num = len(self.index.offsets) - 1
+            self._moved(record.name, record.quantity, "receipt")
+        self._durable(ticket)
+        return num
+
+    def add_many(self, rows):
+        """Add new items from 5-field rows in one append and one sync.
+
+        Rows naming an item already stored, or one earlier in rows, are
+        skipped; their names are returned.
+        """
+        records = [self.check(fields) for fields in rows]
+        skipped = []
+        with self.writing():
+            entries, added = [], {}
+            for record in records:
+                if record.name in self.index.names or record.name in added:
+                    skipped.append(record.name)
+                    continue
+                entries.extend(self.format.encode(record))
+                added[record.name] = record
+            ticket = self._append(entries) if entries else None
+            if self.ledger is not None:
+                self.ledger.append_many([(record.name, record.quantity, "receipt", None)
+                                         for record in added.values() if record.quantity])
+        self._durable(ticket)
+        return skipped
+
+    def update(self, fields):
+        record = self.check(fields)
+        with self.writing():
+            if record.name not in self.index.names:
+                raise KeyError(record.name)
+            old = self._read_at(self.index.names[record.name]) if self.ledger is not None else None
+            ticket = self._append(self.format.encode(record))
+            num = len(self.index.offsets) - 1
+            if old is not None:
+                self._moved(record.name, record.quantity - old.quantity, "adjust")
+            self.maybe_compact()
+        self._durable(ticket)
+        return num
+
+    def move(self, name, delta, kind="adjust"):
+        """Change the quantity of name by delta and log it as a receipt, sale or adjustment."""
+        with self.writing():
+            old = self._read_at(self.index.names[name])
+            if old.quantity + delta < 0:
+                raise ValueError("only %d of %s in stock" % (old.quantity, name))
+            ticket = self._append(self.format.encode(old._replace(quantity=old.quantity + delta)))
+            num = len(self.index.offsets) - 1
+            self._moved(name, delta, kind)
+            self.maybe_compact()
+        self._durable(ticket)
+        return num
+
+    def delete(self, name):
+        with self.writing():
+            if name not in self.index.names:
+                raise KeyError(name)
+            old = self._read_at(self.index.names[name]) if self.ledger is not None else None
+            ticket = self._append(self.format.encode_tombstone(name))
+            if old is not None:
+                self._moved(name, -old.quantity, "adjust")
+            self.maybe_compact()
+        self._durable(ticket)
+
+    def _moved(self, name, delta, kind):
+        # called with the store locked, so the ledger sees changes in log order
+        if self.ledger is not None and delta:
+            self.ledger.append(name, delta, kind)
+
+    def in_category(self, category):
+        """Return the records filed under category, in name order."""
+        with self.lock:
+            self.refresh()
+            return [self.get(name) for name in self.categories.names(category)]
+
+    def category_totals(self):
+        """Return {category: (stock value, items, discounted items)}."""
+        with self.lock:
+            self.refresh()
+            return self.categories.summary()
+
+    def _in_range(self, field, low, high, low_open=False, high_open=False):
+        with self.lock:
+            self.refresh()
+            names = self.ranges.between(field, low, high, low_open, high_open)
+            offsets = self.index.names
+            return [self._read_at(offsets[name]) for name in names]
+
+    def between(self, field, low, high):
+        """Return the records with low <= field <= high, in field order.
+
+        field is price, quantity or discount.
+        """
+        return self._in_range(field, low, high)
+
+    def below(self, field, value):
+        """Return the records with field < value, in field order."""
+        return self._in_range(field, None, value, high_open=True)
+
+    def above(self, field, value):
+        """Return the records with field > value, in field order."""
+        return self._in_range(field, value, None, low_open=True)
+
+    def _load_levels(self):
+        """Read the reorder levels file: CSV rows of item|category, key, level.
+
+        Files from before keys were quoted hold 'kind key level' lines,
+        which still load. Rows that fit neither are skipped and reported.
+        """
+        items, categories = {}, {}
+        self.levels_stamp = None
+        skipped = 0
+        try:
+            with open(self.levels_path, newline='') as src:
+                for row in csv.reader(src):
+                    if len(row) == 1:
+                        row = row[0].split()
+                    try:
+                        kind, key, level = row
+                        if kind not in ("item", "category") or not key:
+                            raise ValueError(kind)
+                        (items if kind == "item" else categories)[key] = int(level)
+                    except ValueError:
+                        skipped += 1
+                stat = os.fstat(src.fileno())
+                self.levels_stamp = (stat.st_ino, stat.st_mtime_ns)
+        except FileNotFoundError:
+            pass
+        if skipped:
+            self.recovered.append("skipped %d unreadable lines of %s" % (skipped, self.levels_path))
+        return items, categories
+
+    def _sync_levels(self):
+        # pick up levels set by another process
+        try:
+            stat = os.stat(self.levels_path)
+            stamp = (stat.st_ino, stat.st_mtime_ns)
+        except FileNotFoundError:
+            stamp = None
+        if stamp != self.levels_stamp:
+            self.item_levels, self.category_levels = self._load_levels()
+            self.lowstock.retune(self.item_levels, self.category_levels)
+
+    def set_reorder(self, level, item=None, category=None):
+        """Set the reorder level of an item or of a whole category.
+
+        An item's own level wins over its category's. level None clears it.
+        """
+        if not (item if item is not None else category):
+            raise ValueError("a reorder level needs an item or category name")
+        if level is not None:
+            level = int(level)
+        with self.writing():
+            self._sync_levels()
+            self.lowstock.set_level(level, item, category)
+            tmp_path = self.levels_path + ".tmp"
+            with open(tmp_path, 'w', newline='') as dst:
+                writer = csv.writer(dst)
+                for kind, levels in (("item", self.item_levels), ("category", self.category_levels)):
+                    for key, value in sorted(levels.items()):
+                        writer.writerow((kind, key, value))
+                dst.flush()
+                os.fsync(dst.fileno())
+            crash_point("levels-written")
+            replace_file(tmp_path, self.levels_path)
+            stat = os.stat(self.levels_path)
+            self.levels_stamp = (stat.st_ino, stat.st_mtime_ns)
+
+    def low_stock(self):
+        """Return (record, reorder level) for every item at or below its level, by name."""
+        with self.lock:
+            self.refresh()
+            self._sync_levels()
+            offsets = self.index.names
+            return [(self._read_at(offsets[name]), level) for name, level in sorted(self.lowstock.low.items())]
+
+    def import_rows(self, rows, batch_size=50000):
+        """Append or replace records from an iterable of 5-field rows.
+
+        Entries are written in batches of batch_size records through one
+        handle and fsynced once at the end. Returns the number of rows loaded.
+        """
+        count = 0
+        with self.writing():
+            data = self.writer
+            batch, movements, latest = [], [], {}
+            try:
+                for fields in rows:
+                    record = self.check(fields)
+                    entries = self.format.encode(record)
+                    if self.ledger is not None:
+                        movements.append(self._imported(record, latest))
+                    batch.extend(entries)
+                    count += 1
+                    if len(batch) >= batch_size:
+                        self._write(data, batch)
+                        self._log(movements)
+                        batch, movements, latest = [], [], {}
+            finally:
+                self._write(data, batch)
+                data.flush()
+                os.fsync(data.fileno())
+                self._log(movements)
+            if self.bloom.count > len(self.index.names) * 2:
+                # mostly replaced or deleted names, size the filter afresh
+                self.bloom.rebuild(self.index.names)
+            self.maybe_compact()
+        return count
+
+    def _imported(self, record, latest):
+        # the movement importing record makes; latest holds the quantities of
+        # records in the batch not yet written, which the index lacks
+        old = latest.get(record.name)
+        if old is None and record.name in self.index.names:
+            old = self._read_at(self.index.names[record.name]).quantity
+        latest[record.name] = record.quantity
+        if old is None:
+            return record.name, record.quantity, "receipt", None
+        return record.name, record.quantity - old, "adjust", None
+
+    def _log(self, movements):
+        if movements:
+            self.ledger.append_many([movement for movement in movements if movement[1]])
+
+    def import_csv(self, path, header=True, batch_size=50000):
+        with open(path, newline='') as src:
+            reader = csv.reader(src)
+            if header:
+                next(reader, None)
+            return self.import_rows(reader, batch_size)
+
+    def scan(self):
+        """Yield every live record in file order."""
+        with self.lock:
+            self.refresh()
+            offsets = array('Q', self.index.offsets)
+            fmt = self.format
+            view = self.mapped()
+        # the mapping stays valid for this scan even if compaction swaps the file
+        for offset in offsets:
+            yield fmt.read_buffer(view, offset)
+
+    def export_csv(self, path, header=True):
+        count = 0
+        with open(path, 'w', newline='') as dst:
+            writer = csv.writer(dst)
+            if header:
+                writer.writerow(FIELDS)
+            for record in self.scan():
+                writer.writerow(record)
+                count += 1
+        return count
+
+    def maybe_compact(self):
+        index = self.index
+        if (index.entries >= self.compact_min and index.dead_ratio() > self.compact_ratio
+                and (self.compactor is None or not self.compactor.is_alive())):
+            self.compactor = threading.Thread(target=self.compact, daemon=True)
+            self.compactor.start()
+
+    def compact(self):
+        """Rewrite the live records into a new log and swap it in.
+
+        The new log is fsynced before it is renamed over the old one and
+        the directory after, so a crash at any point leaves one whole log.
+        Only one process compacts at a time; the others skip.
+        """
+        if not self.compact_lock.acquire(blocking=False):
+            return
+        try:
+            self._compact()
+        finally:
+            self.compact_lock.release()
+
+    def _compact(self):
+        with self.lock:
+            self.refresh()
+            old = self.format
+            offsets = array('Q', self.index.offsets)
+            size = self.index.size
+            identity = self.identity
+            data = open(self.path, 'rb')
+        stat = os.fstat(data.fileno())
+        if (stat.st_dev, stat.st_ino) != identity:
+            data.close()
+            return
+        tmp_path = "%s.compact%d" % (self.path, os.getpid())
+        fresh = type(old)()
+        index = LogIndex(len(fresh.header))
+
+        def copy(working, entries):
+            for raw, name, record in entries:
+                working.write(raw)
+                index.apply(index.size, index.size + len(raw), name, record)
+
+        try:
+            with data, open(tmp_path, 'wb') as working:
+                working.write(fresh.header)
+                # copy the live records as of size without holding the locks
+                for offset in offsets:
+                    copy(working, fresh.encode(old.read(data, offset)))
+                with self.writing():
+                    if self.identity != identity:
+                        # another process compacted first
+                        working.close()
+                        os.remove(tmp_path)
+                        return
+                    # then carry over whatever was appended meanwhile
+                    for offset, end, name, record in old.entries(data, size):
+                        if record is not None:
+                            copy(working, fresh.encode(record))
+                        elif name is not None:
+                            copy(working, fresh.encode_tombstone(name))
+                    working.flush()
+                    os.fsync(working.fileno())
+                    working.close()
+                    crash_point("compact-written")
+                    data.close()
+                    self.view = None
+                    try:
+                        os.replace(tmp_path, self.path)
+                    except PermissionError:
+                        # Windows refuses while another process has the log open
+                        os.remove(tmp_path)
+                        return
+                    crash_point("compact-replaced")
+                    sync_dir(self.path)
+                    self._open()
+                    self.format = fresh
+                    self.index = index
+                    # drop the deleted names from the filter
+                    self.bloom.rebuild(index.names)
+                    self.save_index()
+        except BaseException:
+            # a record the fresh file cannot take, or a failed write: leave no copy behind
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+
+def open_store(path=DATA_FILE, **options):
+    """Open the inventory at path: SQLite for .db/.sqlite files, shards for
+    a .shards directory, else the log.
+
+    options go to InventoryStore (every shard's); SQLite only takes durable
+    and ledger.
+    """
+    if path.endswith((".db", ".sqlite")):
+        from pms_sqlite import SqliteStore
+        return SqliteStore(path, durable=options.get("durable", True), ledger=options.get("ledger"))
+    if path.endswith(".shards"):
+        from pms_shard import ShardedStore
+        return ShardedStore(path, **options)
+    return InventoryStore(path, **options)
+
+
+def convert(src_path, dst_path, fmt="binary"):
+    """Copy the live records of src_path into a new dst_path log in fmt."""
+    if os.path.exists(dst_path) and os.path.getsize(dst_path):
+        raise FileExistsError(dst_path)
+    src = InventoryStore(src_path)
+    dst = InventoryStore(dst_path, fmt=fmt)
+    count = dst.import_rows(src.scan())
+    src.close()
+    dst.close()
+    return count